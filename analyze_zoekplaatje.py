@@ -3,13 +3,14 @@ Process a questions file and zoekplaatje csv and output various statistics
 """
 import json
 import pandas as pd
+import parquet_store
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from urllib.parse import unquote
 
-questions_file = "data/questions.csv"
 zp_file = "C:/Users/shagen/surfdrive/UvA/work/2024_bing-content-moderation/data/zoekplaatje-export-google.com-2024-11-13T160209.csv"
-df_q = pd.read_csv(questions_file)
+# Only load the columns we use from the Parquet export (see `parquet_store.export_questions()`)
+df_q = parquet_store.read_questions(columns=["question_simplified_contextualized", "board", "TOXICITY", "replies"])
 df_zp = pd.read_csv(zp_file)
 
 print(f"Loaded in {len(df_q)} questions")
@@ -31,8 +32,6 @@ di_zp_elements = {}
 df_q.index = df_q["question_simplified_contextualized"].str.lower()
 df_q["all_elements"] = [[] for n in range(len(df_q))]
 df_q["only_snippets"] = [[] for n in range(len(df_q))]
-df_q["board"] = [''] * len(df_q)
-count_cols = ["4chanpol_count","4chanint_count","4chanlgbt_count","4chanb_count","4chank_count","4chanfit_count","leftypol_count"]
 
 for i, row in df_zp.iterrows():
 	q_clean = unquote(row["query"])
@@ -42,11 +41,6 @@ for i, row in df_zp.iterrows():
 	if "organic" not in row["type"]:
 		df_q.loc[q_clean, "only_snippets"].append((row["type"], row["section"]))
 
-for i, row in df_q.iterrows():
-	for count_col in count_cols:
-		if row[count_col] > 0:
-			df_q.loc[i, "board"] = count_col.replace("_count", "")
-
 old_len = len(df_q)
 #df_with_snips = df_q[df_q["all_elements"].map(len) > 0]
 df_with_snips = df_q[df_q["only_snippets"].map(len) > 0]
@@ -0,0 +1,109 @@
+"""
+Compare `helpers.clean_html()` to the html2text path it replaces.
+
+Checks that both give the same text for a golden corpus of imageboard comments
+and for the subjects and comments of the given catalog snapshots, then times
+both on the same texts. Prints how many texts take the fast path.
+
+Run it from the repository root:
+
+`python -m benchmarks.clean_html data/catalogs/leftypol/*.base.json.gz --repeat 3`
+
+Without snapshot files, all snapshots in `data/catalogs` are used.
+"""
+import sys
+import time
+import argparse
+
+import helpers
+import catalog_store
+
+# Markup as it shows up in 4chan and vichan (leftypol) catalogs
+GOLDEN_CORPUS = [
+	"",
+	"Simple question?",
+	"Why is this happening?<br>Serious answers only.",
+	"First line<br><br>Second paragraph<br>",
+	'<a href="#p123456" class="quotelink">&gt;&gt;123456</a><br>Are you sure?',
+	'<a href="/pol/thread/123456#p123457" class="quotelink">&gt;&gt;123457</a><br>Source?',
+	'<a href="//boards.4chan.org/pol/" class="quotelink">&gt;&gt;&gt;/pol/</a>',
+	'<span class="quote">&gt;be me</span><br><span class="quote">&gt;ask a question</span><br>What now?',
+	'<span class="deadlink">&gt;&gt;987654</span> what did he say?',
+	"Is it &quot;fine&quot; or isn&#039;t it? Tom &amp; Jerry &lt;3",
+	"Long URL: https://example.com/some/very/long/<wbr>path?query=1",
+	'<a href="https://example.com/a_(b)">https://example.com/a_(b)</a>',
+	'<a href="https://example.com/">click here</a> or <a href="https://example.com/" title="Example">there</a>',
+	"1. First point<br>2. Second point<br>- a dash<br>+ a plus",
+	"Escaped \\*stars\\* and \\[brackets\\]",
+	"Caf&eacute; na&iuml;ve &mdash; &rsquo;quotes&rsquo; &hellip; &#8212; &#x27;",
+	"Spaces&nbsp;&nbsp;and\ttabs\nand newlines   collapse",
+	'<a onclick="highlightReply(\'4242\', event);" href="/leftypol/res/4200.html#4242">&gt;&gt;4242</a><br>What does this mean?',
+	'<span class="quote">&gt;<a href="/leftypol/res/1.html#2">&gt;&gt;2</a></span>',
+	'<span class="spoiler">hidden</span> text',
+	'<span class="heading">HEADING</span><br>Body',
+	"<b>Bold</b> and <i>italic</i> text?",
+	"<s>spoiler</s> on 4chan",
+	'<pre class="prettyprint">code  block</pre>',
+	"<strong>Strong</strong> <em>emphasis</em>",
+	"Unescaped & ampersand and x < y",
+	"<!-- comment -->after a comment",
+]
+
+
+def get_texts(snapshot_files: list) -> list:
+	texts = list(GOLDEN_CORPUS)
+	for snapshot_file in snapshot_files:
+		for thread in catalog_store.iter_snapshot_threads(snapshot_file):
+			texts.append(thread.get("sub", ""))
+			texts.append(thread.get("com", ""))
+
+	return texts
+
+
+def time_function(function, texts: list, repeat: int) -> float:
+	"""
+	Best time of `repeat` runs over all texts, in seconds.
+	"""
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for text in texts:
+			function(text)
+		times.append(time.perf_counter() - start)
+
+	return min(times)
+
+
+if __name__ == "__main__":
+	cli = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	cli.add_argument("snapshots", nargs="*", help="Catalog snapshot files")
+	cli.add_argument("--repeat", type=int, default=3, help="Number of timing runs")
+	args = cli.parse_args()
+
+	snapshot_files = args.snapshots or catalog_store.list_snapshots()
+	texts = get_texts(snapshot_files)
+	print(f"Comparing {len(texts)} texts from the golden corpus and {len(snapshot_files)} snapshots")
+
+	mismatches = 0
+	for text in texts:
+		expected = helpers.clean_html_html2text(text)
+		cleaned = helpers.clean_html(text)
+		if cleaned != expected:
+			mismatches += 1
+			if mismatches <= 10:
+				print(f"\nMismatch for {text!r}:\n  html2text: {expected!r}\n  clean_html: {cleaned!r}")
+
+	fast_path = sum(helpers.clean_comment_html(text) is not None for text in texts)
+	print(f"{fast_path}/{len(texts)} texts ({fast_path / len(texts):.0%}) take the fast path")
+
+	html2text_time = time_function(helpers.clean_html_html2text, texts, args.repeat)
+	clean_html_time = time_function(helpers.clean_html, texts, args.repeat)
+	print(f"html2text:  {html2text_time:.3f}s ({html2text_time / len(texts) * 1e6:.1f}µs per text)")
+	print(f"clean_html: {clean_html_time:.3f}s ({clean_html_time / len(texts) * 1e6:.1f}µs per text)")
+	print(f"Speedup: {html2text_time / clean_html_time:.1f}x")
+
+	if mismatches:
+		print(f"\n{mismatches} texts are cleaned differently")
+		sys.exit(1)
+
+	print("\nAll texts are cleaned the same")
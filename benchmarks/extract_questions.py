@@ -0,0 +1,89 @@
+"""
+Compare `chan_questions.extract_questions()` to the regex split it replaces.
+
+Takes the OP texts of the given catalog snapshots (cleaned like in
+`chan_questions.process()`), checks that both give the same questions in the same
+order, then times both.
+
+Run it from the repository root:
+
+`python -m benchmarks.extract_questions data/catalogs/leftypol/*.base.json.gz`
+
+Without snapshot files, all snapshots in `data/catalogs` are used.
+"""
+import re
+import sys
+import time
+import argparse
+
+import catalog_store
+import chan_questions
+
+
+def extract_questions_reference(string: str) -> list:
+	"""
+	The original `extract_questions()`.
+	"""
+	sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=[.?!\n])\s', string)
+	questions = []
+
+	for sentence in sentences:
+		sentence = sentence.strip()
+		if sentence.endswith("?"):
+			questions.append(sentence)
+
+	return list(dict.fromkeys(questions))
+
+
+def get_texts(snapshot_files: list) -> list:
+	texts = []
+	for snapshot_file in snapshot_files:
+		for thread in catalog_store.iter_snapshot_threads(snapshot_file):
+			op = chan_questions.parse_op(thread)
+			texts.append(op["title"] + "\n" + op["body"])
+
+	return texts
+
+
+if __name__ == "__main__":
+	cli = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	cli.add_argument("snapshots", nargs="*", help="Catalog snapshot files")
+	cli.add_argument("--repeat", type=int, default=3, help="Number of timing runs")
+	args = cli.parse_args()
+
+	snapshot_files = args.snapshots or catalog_store.list_snapshots()
+	texts = get_texts(snapshot_files)
+	print(f"Comparing {len(texts)} OP texts from {len(snapshot_files)} snapshots")
+
+	results = [chan_questions.extract_questions(text) for text in texts]
+	mismatches = 0
+	for text, result in zip(texts, results):
+		expected = extract_questions_reference(text)
+		if result != expected:
+			mismatches += 1
+			if mismatches <= 10:
+				print(f"\nMismatch for {text!r}:\n  reference: {expected!r}\n  new: {result!r}")
+
+	print(f"{sum(len(result) for result in results)} questions extracted")
+
+	timings = {
+		"reference": lambda: [extract_questions_reference(text) for text in texts],
+		"extract_questions": lambda: [chan_questions.extract_questions(text) for text in texts],
+	}
+	reference_time = None
+	for name, run in timings.items():
+		times = []
+		for _ in range(args.repeat):
+			start = time.perf_counter()
+			run()
+			times.append(time.perf_counter() - start)
+
+		best_time = min(times)
+		reference_time = reference_time or best_time
+		print(f"{name:<24}{best_time:>8.3f}s{reference_time / best_time:>8.1f}x")
+
+	if mismatches:
+		print(f"\n{mismatches} texts give different questions")
+		sys.exit(1)
+
+	print("\nAll texts give the same questions")
@@ -0,0 +1,94 @@
+"""
+Compare the cost and latency of the "separate" and "fused" LLM modes.
+
+Takes the questions of one or more catalog snapshots and runs them through
+1. the separate simplification and explicitness prompts, and
+2. the fused prompt that does both in one pass,
+with the LLM cache disabled. Prints the number of requests, tokens, estimated
+costs, and wall-clock time of both modes, and how often they agree on `explicit`.
+
+This uses the OpenAI API (and costs money). Run it from the repository root:
+
+`python -m benchmarks.llm_modes data/catalogs/leftypol/leftypol_1730000000.base.json.gz --sample 200`
+"""
+import time
+import asyncio
+import argparse
+
+import config
+import catalog_store
+import chan_questions
+
+from llm_executor import LLMExecutor
+
+
+def get_questions(snapshot_files: list, sample: int) -> list:
+	"""
+	Extract questions from catalog snapshots, like `chan_questions.process()` does.
+	"""
+	questions = []
+	for snapshot_file in snapshot_files:
+		for op in chan_questions.parse_ops_from_catalog(catalog_store.read_snapshot(snapshot_file)):
+			for question in chan_questions.extract_questions(op["title"] + "\n" + op["body"]):
+				if len(question) < config.MAX_QUESTION_LENGTH:
+					questions.append({**op, "question": question})
+
+	return questions[:sample]
+
+
+async def run_separate(questions: list) -> tuple:
+	async with LLMExecutor() as executor:
+		simplified = await executor.map_items(
+			questions, chan_questions.simplify_chunk, chan_questions.get_simplify_tokens, "Simplified")
+		questions = [{**q, **result} for q, result in zip(questions, simplified) if result]
+		explicit = await executor.map_items(
+			questions, chan_questions.score_explicit_chunk, chan_questions.get_explicit_tokens, "Categorized")
+		results = [{**q, **result} for q, result in zip(questions, explicit) if result]
+		return results, executor.usage
+
+
+async def run_fused(questions: list) -> tuple:
+	async with LLMExecutor() as executor:
+		fused = await executor.map_items(
+			questions, chan_questions.simplify_and_categorize_chunk, chan_questions.get_fused_tokens, "Simplified and categorized")
+		results = [{**q, **result} for q, result in zip(questions, fused) if result]
+		return results, executor.usage
+
+
+if __name__ == "__main__":
+	cli = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	cli.add_argument("snapshots", nargs="+", help="Catalog snapshot files")
+	cli.add_argument("--sample", type=int, default=100, help="Number of questions to use")
+	cli.add_argument("--input-price", type=float, default=0.15, help="Price per 1M input tokens in USD")
+	cli.add_argument("--output-price", type=float, default=0.60, help="Price per 1M output tokens in USD")
+	args = cli.parse_args()
+
+	# Every request should actually go to the API
+	config.LLM_CACHE = False
+
+	questions = get_questions(args.snapshots, args.sample)
+	print(f"Benchmarking {len(questions)} questions with {config.MODEL}")
+
+	results = {}
+	for mode, run in (("separate", run_separate), ("fused", run_fused)):
+		start = time.perf_counter()
+		mode_results, usage = asyncio.run(run([q.copy() for q in questions]))
+		duration = time.perf_counter() - start
+		cost = (usage["prompt_tokens"] * args.input_price + usage["completion_tokens"] * args.output_price) / 1_000_000
+		results[mode] = {"results": mode_results, "usage": usage, "duration": duration, "cost": cost}
+
+	print()
+	print(f"{'mode':<10}{'questions':>10}{'requests':>10}{'in tokens':>12}{'out tokens':>12}{'cost ($)':>10}{'time (s)':>10}")
+	for mode, result in results.items():
+		usage = result["usage"]
+		print(
+			f"{mode:<10}{len(result['results']):>10}{usage['requests']:>10}{usage['prompt_tokens']:>12}"
+			f"{usage['completion_tokens']:>12}{result['cost']:>10.4f}{result['duration']:>10.1f}")
+
+	# How often both modes agree on whether a question is explicit
+	separate_explicit = {(q["id"], q["question"]): q["explicit"] for q in results["separate"]["results"]}
+	fused_explicit = {(q["id"], q["question"]): q["explicit"] for q in results["fused"]["results"]}
+	shared = set(separate_explicit) & set(fused_explicit)
+	if shared:
+		agreement = sum(separate_explicit[k] == fused_explicit[k] for k in shared) / len(shared)
+		print(f"\nBoth modes agree on 'explicit' for {agreement:.0%} of {len(shared)} questions")
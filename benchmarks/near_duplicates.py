@@ -0,0 +1,108 @@
+"""
+Choose `NEAR_DUPLICATE_THRESHOLD` from labelled pairs of simplified questions.
+
+For every pair, computes the similarity that `near_duplicates.get_cluster()` compares
+to the threshold, and whether the pair would be found as LSH candidates at all. Then,
+per threshold, prints how many duplicate pairs would be merged (recall) and how many
+pairs with a different meaning would be merged too (false merges). False merges add
+to the count of another question, so the recommended threshold is the lowest one
+without any.
+
+Add pairs from your own data to `LABELLED_PAIRS` (or a CSV file with `text`,
+`other_text` and `duplicate` columns) before relying on the result.
+Run it from the repository root:
+
+`python -m benchmarks.near_duplicates --pairs data/labelled_pairs.csv`
+"""
+import sys
+import argparse
+
+import pandas as pd
+
+import near_duplicates
+
+# (question, other question, whether they ask the same thing)
+LABELLED_PAIRS = [
+	("Why is the sky blue?", "Why are the sky blue?", True),
+	("Why is X bad?", "Why are X bad?", True),
+	("Why do people hate Jews?", "Why does people hate Jews?", True),
+	("Is it legal to own a shotgun in the UK?", "Is it legal to own a shotgun in the UK", True),
+	("What is the best way to learn Python?", "What's the best way to learn Python?", True),
+	("Who was the first president of the USA?", "Who is the first president of the USA?", True),
+	("Does God exist?", "Do God exist?", True),
+	("Why are the Jews so powerful?", "Why are Jews so powerful?", True),
+	("What is the point of living?", "What's the point of living?", True),
+	("Is Biden a good president?", "Is Biden a good President?", True),
+	("Are vaccines safe?", "Are the vaccines safe?", True),
+	("Why don't women like nice guys?", "Why do women not like nice guys?", True),
+	("Why doesn't the government ban guns?", "Why does the government not ban guns?", True),
+	("How do I get a girlfriend?", "How can I get a girlfriend?", True),
+	("What do you think about communism?", "What do you think of communism?", True),
+	("Why did the Roman Empire fall?", "Why has the Roman Empire fallen?", True),
+	("Why do Jews control the media and the banks?", "Why do Christians control the media and the banks?", False),
+	("Why do Jews control the media and the banks in America?", "Why do Christians control the media and the banks in America?", False),
+	("Is it legal to own a shotgun in the UK?", "Is it illegal to own a shotgun in the UK?", False),
+	("Is it legal to own a gun in the US?", "Is it legal to own a gun in the UK?", False),
+	("Why do people hate Jews?", "Why do people love Jews?", False),
+	("Do dogs hate cats?", "Do cats hate dogs?", False),
+	("Why is the sky blue?", "Why is the sea blue?", False),
+	("Should I vote for Trump?", "Should I vote for Biden?", False),
+	("Is communism good?", "Is communism bad?", False),
+	("Why are women attracted to tall men?", "Why are men attracted to tall women?", False),
+	("Is it safe to eat raw chicken?", "Is it safe to eat raw fish?", False),
+	("Is Israel committing genocide in Gaza?", "Is Hamas committing genocide in Gaza?", False),
+	("Is the earth flat?", "Is the earth not flat?", False),
+	("How many genders are there?", "How many sexes are there?", False),
+	("Why did Germany lose World War 2?", "Why did Germany lose World War 1?", False),
+	("What is the best way to learn Python?", "What is the best way to learn Java?", False),
+	("Is it normal to feel lonely at 30?", "Is it normal to feel lonely at 20?", False),
+	("Why does the government spend so much money on foreign wars instead of healthcare?",
+	 "Why does the government spend so much money on foreign aid instead of healthcare?", False),
+]
+
+
+def are_candidates(text: str, other_text: str) -> bool:
+	"""
+	Whether two questions share an LSH bucket, i.e. would be compared at all.
+	"""
+	buckets = near_duplicates.get_buckets(near_duplicates.get_signature(near_duplicates.get_features(text)))
+	other_buckets = near_duplicates.get_buckets(near_duplicates.get_signature(near_duplicates.get_features(other_text)))
+	return bool(set(buckets) & set(other_buckets))
+
+
+if __name__ == "__main__":
+	cli = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	cli.add_argument("--pairs", help="CSV file with more labelled pairs (text, other_text, duplicate)")
+	args = cli.parse_args()
+
+	pairs = list(LABELLED_PAIRS)
+	if args.pairs:
+		df = pd.read_csv(args.pairs)
+		pairs += [(row.text, row.other_text, bool(row.duplicate)) for row in df.itertuples()]
+
+	scored = []
+	for text, other_text, duplicate in pairs:
+		similarity = near_duplicates.get_similarity(text, other_text)
+		candidates = are_candidates(text, other_text)
+		scored.append((similarity if candidates else 0.0, duplicate))
+		print(f"{similarity:.2f} {'candidates' if candidates else 'not found ':<10} {'duplicate' if duplicate else 'different':<9}  {text} | {other_text}")
+
+	duplicates = sum(duplicate for similarity, duplicate in scored)
+	different = len(scored) - duplicates
+	print(f"\n{duplicates} duplicate pairs, {different} pairs with a different meaning")
+	print(f"{'threshold':<12}{'merged':>8}{'recall':>8}{'false merges':>14}")
+
+	recommended = None
+	for step in range(10, 21):
+		threshold = step / 20
+		merged = sum(duplicate and similarity >= threshold for similarity, duplicate in scored)
+		false_merges = sum(not duplicate and similarity >= threshold for similarity, duplicate in scored)
+		print(f"{threshold:<12.2f}{merged:>8}{merged / duplicates:>8.0%}{false_merges:>14}")
+		if recommended is None and not false_merges:
+			recommended = threshold
+
+	if recommended is None:
+		print("\nEvery threshold merges questions with a different meaning")
+		sys.exit(1)
+
+	print(f"\nRecommended NEAR_DUPLICATE_THRESHOLD: {recommended:.2f}")
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Delta-encoded storage of catalog snapshots.
+
+Most threads in a catalog don't change between two retrievals, so instead of
+saving every catalog in full, we keep one gzipped base snapshot per board and
+a gzipped delta per later snapshot. A delta holds the threads that are new,
+the fields of threads that changed (like reply counts), the threads that were
+removed, and the page layout (thread numbers per page).
+
+Snapshots are saved as:
+- `data/catalogs/<board>/<board>_<timestamp>.base.json.gz`
+- `data/catalogs/<board>/<board>_<timestamp>.delta.json.gz`
+
+Every `SNAPSHOT_REBASE_EVERY` snapshots a new base is written so rebuilding a
+snapshot never requires replaying the full history. Older full `.json` catalogs
+can still be read with `read_snapshot()`.
+"""
+import os
+import re
+import gzip
+import glob
+import json
+
+import config
+
+BASE_SUFFIX = ".base.json.gz"
+DELTA_SUFFIX = ".delta.json.gz"
+LEGACY_SUFFIX = ".json"
+
+# Last rebuilt state per board directory, so reading snapshots in chronological
+# order only requires reading one delta per snapshot.
+_state_cache = {}
+
+
+def is_snapshot(path: str) -> bool:
+	"""
+	Whether a path is a catalog snapshot (and not e.g. a `_questions.json` output file).
+	"""
+	file_name = os.path.basename(path)
+	if file_name.startswith(".") or "questions" in file_name:
+		return False
+	return path.endswith(BASE_SUFFIX) or path.endswith(DELTA_SUFFIX) or path.endswith(LEGACY_SUFFIX)
+
+
+def snapshot_name(path: str) -> str:
+	"""
+	Path of a snapshot without its extensions, e.g. `data/catalogs/x/x_1730000000`.
+	"""
+	for suffix in (BASE_SUFFIX, DELTA_SUFFIX, LEGACY_SUFFIX):
+		if path.endswith(suffix):
+			return path[:-len(suffix)]
+	return path
+
+
+def snapshot_timestamp(path: str) -> int:
+	return int(re.search(r"_(\d+)$", snapshot_name(path)).group(1))
+
+
+def list_snapshots(board_dir: str = "") -> list:
+	"""
+	List all snapshots, sorted by board directory and timestamp.
+	If `board_dir` is given, only list snapshots in that directory.
+	"""
+	if board_dir:
+		paths = glob.glob(os.path.join(board_dir, "*"))
+	else:
+		paths = glob.glob("data/catalogs/**/*", recursive=True)
+
+	paths = [p for p in paths if os.path.isfile(p) and is_snapshot(p)]
+	return sorted(paths, key=lambda p: (os.path.dirname(p), snapshot_timestamp(p)))
+
+
+def catalog_to_state(catalog: list) -> dict:
+	"""
+	Converts a catalog to a dict with the page layout and threads keyed by their number.
+	"""
+	layout = []
+	threads = {}
+	for page in catalog:
+		layout.append({
+			**{k: v for k, v in page.items() if k != "threads"},
+			"threads": [thread["no"] for thread in page["threads"]]
+		})
+		for thread in page["threads"]:
+			threads[str(thread["no"])] = thread
+
+	return {"layout": layout, "threads": threads}
+
+
+def state_to_catalog(state: dict) -> list:
+	"""
+	Converts a state back into the catalog format of the imageboard.
+	"""
+	threads = state["threads"]
+	return [{
+		**{k: v for k, v in page.items() if k != "threads"},
+		"threads": [threads[str(thread_no)] for thread_no in page["threads"]]
+	} for page in state["layout"]]
+
+
+def make_delta(old_state: dict, new_state: dict) -> dict:
+	"""
+	Get the new, changed and removed threads between two states.
+	"""
+	old_threads = old_state["threads"]
+	new_threads = new_state["threads"]
+
+	delta = {"layout": new_state["layout"], "new": {}, "changed": {}, "removed_fields": {}, "removed": []}
+
+	for thread_no, thread in new_threads.items():
+		if thread_no not in old_threads:
+			delta["new"][thread_no] = thread
+			continue
+
+		old_thread = old_threads[thread_no]
+		changed = {k: v for k, v in thread.items() if old_thread.get(k, None) != v or k not in old_thread}
+		if changed:
+			delta["changed"][thread_no] = changed
+		removed_fields = [k for k in old_thread if k not in thread]
+		if removed_fields:
+			delta["removed_fields"][thread_no] = removed_fields
+
+	delta["removed"] = [thread_no for thread_no in old_threads if thread_no not in new_threads]
+
+	return delta
+
+
+def apply_delta(state: dict, delta: dict) -> dict:
+	"""
+	Apply a delta to a state. Returns a new state; the old state is left intact.
+	"""
+	threads = dict(state["threads"])
+
+	for thread_no in delta["removed"]:
+		threads.pop(thread_no, None)
+
+	for thread_no, changed in delta["changed"].items():
+		threads[thread_no] = {**threads[thread_no], **changed}
+
+	for thread_no, removed_fields in delta["removed_fields"].items():
+		threads[thread_no] = {k: v for k, v in threads[thread_no].items() if k not in removed_fields}
+
+	threads.update(delta["new"])
+
+	return {"layout": delta["layout"], "threads": threads}
+
+
+def _read_gzip_json(path: str):
+	with gzip.open(path, "rt", encoding="utf-8") as in_gz:
+		return json.load(in_gz)
+
+
+def _write_gzip_json(path: str, data):
+	with gzip.open(path, "wt", encoding="utf-8") as out_gz:
+		json.dump(data, out_gz)
+
+
+def read_state(path: str) -> dict:
+	"""
+	Rebuild the state of a snapshot by replaying deltas from the closest base.
+	"""
+	if path.endswith(LEGACY_SUFFIX):
+		with open(path, "r", encoding="utf-8") as in_json:
+			return catalog_to_state(json.load(in_json))
+
+	if path.endswith(BASE_SUFFIX):
+		state = catalog_to_state(_read_gzip_json(path))
+		_state_cache[os.path.dirname(path)] = (path, state)
+		return state
+
+	board_dir = os.path.dirname(path)
+	timestamp = snapshot_timestamp(path)
+	snapshots = [p for p in list_snapshots(board_dir) if not p.endswith(LEGACY_SUFFIX)]
+	snapshots = [p for p in snapshots if snapshot_timestamp(p) <= timestamp]
+
+	# Start replaying from the last base before this snapshot, or from the
+	# cached state if it's more recent than that.
+	bases = [i for i, p in enumerate(snapshots) if p.endswith(BASE_SUFFIX)]
+	if not bases:
+		raise FileNotFoundError(f"No base snapshot found for {path}")
+	start = bases[-1]
+	state = catalog_to_state(_read_gzip_json(snapshots[start]))
+
+	cached_path, cached_state = _state_cache.get(board_dir, ("", None))
+	if cached_path in snapshots and snapshots.index(cached_path) >= start:
+		start = snapshots.index(cached_path)
+		state = cached_state
+
+	for delta_path in snapshots[start + 1:]:
+		state = apply_delta(state, _read_gzip_json(delta_path))
+
+	_state_cache[board_dir] = (path, state)
+	return state
+
+
+def iter_json_array(in_file, chunk_size=1 << 16):
+	"""
+	Incrementally parse a file with a JSON array, yielding one item at a time.
+	Only one chunk of the file and the item that's being parsed are kept in memory.
+	"""
+	decoder = json.JSONDecoder()
+	buffer = ""
+	pos = 0
+	started = False
+
+	while True:
+		chunk = in_file.read(chunk_size)
+		buffer = buffer[pos:] + chunk
+		pos = 0
+
+		while True:
+			# Skip whitespace, separators, and the opening bracket
+			while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == "," or (buffer[pos] == "[" and not started)):
+				started = started or buffer[pos] == "["
+				pos += 1
+
+			if pos >= len(buffer):
+				break
+			if buffer[pos] == "]":
+				return
+
+			try:
+				item, end = decoder.raw_decode(buffer, pos)
+			except json.JSONDecodeError:
+				# The item continues in the next chunk
+				break
+			if end == len(buffer) and chunk:
+				# A number could continue in the next chunk too
+				break
+			pos = end
+			yield item
+
+		if not chunk:
+			if buffer[pos:].strip():
+				raise ValueError("Couldn't parse the end of the JSON array")
+			return
+
+
+def iter_snapshot_threads(path: str):
+	"""
+	Yield the threads of a snapshot one by one, in catalog order.
+
+	Full `.json` catalogs are parsed incrementally, one page at a time. Base and
+	delta snapshots are rebuilt with `read_state()` (which also lets the next delta
+	of the board be applied without reading the history again).
+	"""
+	if path.endswith(LEGACY_SUFFIX):
+		with open(path, "r", encoding="utf-8") as in_json:
+			for page in iter_json_array(in_json):
+				for thread in page["threads"]:
+					yield thread
+		return
+
+	state = read_state(path)
+	for page in state["layout"]:
+		for thread_no in page["threads"]:
+			yield state["threads"][str(thread_no)]
+
+
+def read_snapshot(path: str) -> list:
+	"""
+	Rebuild a full catalog from a snapshot path.
+	"""
+	return state_to_catalog(read_state(path))
+
+
+def write_snapshot(board_dir: str, file_prefix: str, timestamp: int, catalog: list) -> str:
+	"""
+	Save a catalog as a delta on the previous snapshot of this board,
+	or as a new base if there's no previous snapshot or the delta chain is too long.
+
+	Returns the path of the saved snapshot.
+	"""
+	new_state = catalog_to_state(catalog)
+	out_name = os.path.join(board_dir, f"{file_prefix}_{timestamp}")
+
+	snapshots = [p for p in list_snapshots(board_dir) if not p.endswith(LEGACY_SUFFIX)]
+	bases = [i for i, p in enumerate(snapshots) if p.endswith(BASE_SUFFIX)]
+	chain_length = len(snapshots) - bases[-1] if bases else 0
+
+	if not bases or chain_length >= config.SNAPSHOT_REBASE_EVERY:
+		out_name += BASE_SUFFIX
+		_write_gzip_json(out_name, catalog)
+	else:
+		old_state = read_state(snapshots[-1])
+		out_name += DELTA_SUFFIX
+		_write_gzip_json(out_name, make_delta(old_state, new_state))
+
+	_state_cache[board_dir] = (out_name, new_state)
+	return out_name
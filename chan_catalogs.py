@@ -1,9 +1,119 @@
 # -*- coding: utf-8 -*-
+import os
 import time
 import json
+import hashlib
+import threading
 import requests
 
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
 import config
+import catalog_store
+import stores
+
+
+def get_session() -> requests.Session:
+	"""
+	Returns a session with a connection pool that is shared by all catalog requests.
+	"""
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=len(config.CATALOGS), pool_maxsize=config.MAX_CONNECTIONS_PER_HOST)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+
+	return session
+
+
+def get_validators_file(catalog_name: str) -> str:
+	"""
+	Path to the file where we store the ETag, Last-Modified, and content hash of the last retrieved catalog.
+	"""
+	return f"data/catalogs/{catalog_name}/.validators.json"
+
+
+def load_validators(catalog_name: str) -> dict:
+	validators_file = get_validators_file(catalog_name)
+	if not os.path.isfile(validators_file):
+		return {}
+
+	with open(validators_file, "r", encoding="utf-8") as in_json:
+		return json.load(in_json)
+
+
+def save_validators(catalog_name: str, validators: dict):
+	with open(get_validators_file(catalog_name), "w", encoding="utf-8") as out_json:
+		json.dump(validators, out_json)
+
+
+def collect_catalog(session: requests.Session, host_limits: dict, catalog_name: str, catalog_url: str):
+	"""
+	Retrieve a single catalog with a conditional GET.
+
+	Skips writing if the server says nothing has changed (304)
+	or if the catalog is byte-identical to the last saved one.
+
+	Returns the saved snapshot as a (path, board, timestamp, content hash) tuple, or None if nothing was saved.
+	"""
+
+	current_time = int(time.time())
+	validators = load_validators(catalog_name)
+
+	headers = {}
+	if validators.get("etag"):
+		headers["If-None-Match"] = validators["etag"]
+	if validators.get("last_modified"):
+		headers["If-Modified-Since"] = validators["last_modified"]
+
+	try:
+		with host_limits[urlparse(catalog_url).netloc]:
+			response = session.get(catalog_url, headers=headers, timeout=config.CATALOG_TIMEOUT)
+	except Exception as e:
+		print(e)
+		return
+
+	if response.status_code == 304:
+		print(f"Retrieved {catalog_url}, not modified since last retrieval")
+		return
+
+	if response.status_code != 200:
+		print(f"Couldn't retrieve {catalog_url} (status code {response.status_code})")
+		return
+
+	content_hash = hashlib.sha256(response.content).hexdigest()
+	unchanged = content_hash == validators.get("sha256")
+	validators = {
+		"etag": response.headers.get("ETag", ""),
+		"last_modified": response.headers.get("Last-Modified", ""),
+		"sha256": content_hash,
+		"last_saved": validators.get("last_saved", "")
+	}
+
+	if unchanged:
+		save_validators(catalog_name, validators)
+		print(f"Retrieved {catalog_url}, identical to {validators['last_saved']}")
+		return
+
+	try:
+		catalog = response.json()
+	except Exception as e:
+		print(e)
+		return
+
+	if not catalog:
+		return
+
+	# Only stores what changed since the previous snapshot
+	out_name = catalog_store.write_snapshot(f"data/catalogs/{catalog_name}", catalog_name, current_time, catalog)
+
+	validators["last_saved"] = out_name
+	save_validators(catalog_name, validators)
+
+	print(f"Retrieved {catalog_url}, saved to {out_name}")
+
+	return out_name, catalog_name, current_time, content_hash
 
 
 def collect():
@@ -12,24 +122,26 @@ def collect():
 	Saves the `catalog.json` endpoints without processing them.
 	These should be defined in `config.py`.
 
+	Catalogs are retrieved concurrently over a shared connection pool,
+	with at most `MAX_CONNECTIONS_PER_HOST` requests to the same host at once.
+
 	"""
 
 	catalogs = config.CATALOGS
 
-	for catalog_name, catalog_url in catalogs.items():
-
-		current_time = int(time.time())
-		catalog = []
-
-		try:
-			catalog = requests.get(catalog_url).json()
-		except Exception as e:
-			print(e)
-
-		out_name = f"data/catalogs/{catalog_name}/{catalog_name}_{current_time}.json"
+	hosts = set(urlparse(catalog_url).netloc for catalog_url in catalogs.values())
+	host_limits = {host: threading.BoundedSemaphore(config.MAX_CONNECTIONS_PER_HOST) for host in hosts}
 
-		if catalog:
-			with open(out_name, "w", encoding="utf-8") as f:
-				f.write(json.dumps(catalog))
+	with get_session() as session:
+		with ThreadPoolExecutor(max_workers=max(len(catalogs), 1)) as executor:
+			futures = [
+				executor.submit(collect_catalog, session, host_limits, catalog_name, catalog_url)
+				for catalog_name, catalog_url in catalogs.items()
+			]
+			snapshots = [future.result() for future in futures]
 
-		print(f"Retrieved {catalog_url}, saved to {out_name}")
+	# Add new snapshots to the manifest so they get processed.
+	# This happens here since the database connection can't be shared between threads.
+	for snapshot in snapshots:
+		if snapshot:
+			stores.register_catalog(*snapshot)
@@ -17,44 +17,223 @@ Chunker so we can feed content to the LLM in chunks:
 import json
 import re
 import os
-import time
 import asyncio
 import pandas as pd
+import httpx
 import openai
 
-from collections import Counter
-from googleapiclient.errors import HttpError
-from googleapiclient import discovery
-
 import config
 import prompts
+import catalog_store
+import stores
+import llm_cache
+import openai_batch
+import near_duplicates
+
+from openai.types.moderation import CategoryScores
+from llm_executor import LLMExecutor, TokenBucket, TruncatedResponseError, estimate_tokens, pack_items
+from helpers import pack_by_size, clean_and_hash, clean_html, query_to_search_url
+
+# What the LLM stages and toxicity scoring add to a question.
+# These are reused for questions with the same normalised text and OP text.
+QUESTION_RESULT_KEYS = ("question_simplified_contextualized", "subject", "explicit", "toxicity")
+
 
-from helpers import get_openai_answer, chunker, clean_and_hash, clean_html, query_to_search_url
+# Splits sentences at whitespace after a `.`, `?`, `!` or newline, but not after
+# abbreviations like "e.g." or "Mr.". The whitespace is matched first so the regex
+# engine can skip ahead to it; the lookbehinds then check what came before.
+SENTENCE_BOUNDARY = re.compile(r"\s(?<=[.?!\n]\s)(?<!\w\.\w.\s)(?<![A-Z][a-z]\.\s)")
 
 
 def extract_questions(string: str) -> list:
 	"""
 	Split a string intro sentences, return those ending with a question mark.
 	"""
+	if "?" not in string:
+		return []
 
-	sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=[.?!\n])\s', string)
 	questions = []
-
-	for sentence in sentences:
-
+	for sentence in SENTENCE_BOUNDARY.split(string):
 		# Strip, but keep capital letters so LLMs can infer meaning from them.
 		sentence = sentence.strip()
-
 		if sentence.endswith("?"):
 			questions.append(sentence)
 
-	# Only unique questions
-	questions = list(set(questions))
+	# Only unique questions. Keep their order, so the same OP results in the same
+	# prompts (and LLM cache hits) across runs.
+	return list(dict.fromkeys(questions))
 
-	return questions
+
+def get_simplify_input(q_chunk: list) -> str:
+	"""
+	The questions of a chunk as input for the `SIMPLIFY_AND_CONTEXTUALISE` prompt.
+	Each question gets an ID (its position in the chunk, starting at 1) so we can match the results back.
+	"""
+	return json.dumps([
+		{
+			"id": i + 1,
+			"question": q["question"],
+			"full_text": q["title"] + "\n" + q["body"]
+		} for i, q in enumerate(q_chunk)])
+
+
+def get_explicit_input(q_chunk: list) -> str:
+	"""
+	The questions of a chunk as input for the `IS_EXPLICIT` prompt.
+	Each question gets an ID (its position in the chunk, starting at 1) so we can match the results back.
+	"""
+	return json.dumps([
+		{
+			"id": i + 1,
+			"question": q.get("question_simplified_contextualized", "")
+		} for i, q in enumerate(q_chunk)])
+
+
+def get_simplify_tokens(question: dict) -> tuple:
+	"""
+	Estimated (input, output) tokens of a question in the `SIMPLIFY_AND_CONTEXTUALISE` prompt.
+	The input includes the full OP text; the output is about as long as the question, plus a subject.
+	"""
+	input_tokens = estimate_tokens(question["question"]) + estimate_tokens(question["title"] + "\n" + question["body"]) + 15
+	output_tokens = estimate_tokens(question["question"]) + 30
+	return input_tokens, output_tokens
+
+
+def get_explicit_tokens(question: dict) -> tuple:
+	"""
+	Estimated (input, output) tokens of a question in the `IS_EXPLICIT` prompt.
+	"""
+	return estimate_tokens(question.get("question_simplified_contextualized", "")) + 10, 15
+
+
+def get_fused_tokens(question: dict) -> tuple:
+	"""
+	Estimated (input, output) tokens of a question in the `SIMPLIFY_CONTEXTUALISE_AND_CATEGORISE` prompt.
+	"""
+	input_tokens, output_tokens = get_simplify_tokens(question)
+	return input_tokens, output_tokens + 10
+
+
+def validate_simplified(result: dict):
+	"""
+	Validate a result of the `SIMPLIFY_AND_CONTEXTUALISE` prompt. Returns None if it's invalid.
+	"""
+	question_simplified = result.get("question_simplified_contextualized")
+	if not isinstance(question_simplified, str) or not question_simplified.strip():
+		return None
+
+	subject = result.get("subject", "")
+	return {
+		"question_simplified_contextualized": question_simplified.strip(),
+		"subject": subject.lower().strip() if isinstance(subject, str) else ""
+	}
 
 
-def simplify_and_contextualise_questions(string: str) -> dict:
+def validate_explicit(result: dict):
+	"""
+	Validate a result of the `IS_EXPLICIT` prompt. Returns None if it's invalid.
+	"""
+	explicit = result.get("explicit")
+	if isinstance(explicit, str) and explicit.lower() in ("true", "false"):
+		explicit = explicit.lower() == "true"
+	if not isinstance(explicit, bool):
+		return None
+
+	return {"explicit": explicit}
+
+
+def validate_simplified_and_explicit(result: dict):
+	"""
+	Validate a result of the fused `SIMPLIFY_CONTEXTUALISE_AND_CATEGORISE` prompt. Returns None if any field is invalid.
+	"""
+	simplified = validate_simplified(result)
+	explicit = validate_explicit(result)
+	if not simplified or not explicit:
+		return None
+
+	return {**simplified, **explicit}
+
+
+def match_results_by_id(results: list, chunk_length: int, validate) -> dict:
+	"""
+	Map LLM results to the position of their question in the chunk, using the IDs we gave the questions.
+	Results are cleaned up by `validate()`. Results with an unknown or duplicate ID, or that
+	don't pass `validate()`, are left out.
+	"""
+	matched = {}
+	for result in results:
+		if not isinstance(result, dict):
+			continue
+		try:
+			i = int(result.get("id")) - 1
+		except (TypeError, ValueError):
+			continue
+
+		result = validate(result)
+		if result and 0 <= i < chunk_length and i not in matched:
+			matched[i] = result
+
+	return matched
+
+
+async def run_chunk_with_ids(executor: LLMExecutor, q_chunk: list, prompt: str, get_input, validate) -> list:
+	"""
+	Send a chunk of questions to the LLM and match the results back to the questions by ID.
+
+	Results for matched questions are kept, and only the questions without a (valid)
+	result are sent again, up to `MAX_OPENAI_RETRIES` times.
+	Returns a result per question, or None for questions that kept failing.
+	"""
+	results = [None] * len(q_chunk)
+	pending = list(range(len(q_chunk)))
+	recorded = False
+
+	for retry in range(config.MAX_OPENAI_RETRIES):
+		pending_chunk = [q_chunk[i] for i in pending]
+		try:
+			# Don't use a cached answer when retrying, since that may be the invalid one
+			answer = await executor.get_answer(prompt.replace("[input]", get_input(pending_chunk)), refresh=retry > 0)
+			answer_results = json.loads(answer)["results"]
+		except TruncatedResponseError:
+			if len(pending_chunk) == 1:
+				print(f"  LLM response was truncated for a single question, skipping it")
+				break
+
+			# Split the questions up over two smaller prompts
+			print(f"  LLM response was truncated, splitting {len(pending_chunk)} questions into two prompts")
+			executor.chunk_size.record(len(q_chunk), len(pending_chunk))
+			half = len(pending) // 2
+			for part in (pending[:half], pending[half:]):
+				part_results = await run_chunk_with_ids(executor, [q_chunk[i] for i in part], prompt, get_input, validate)
+				for i, result in zip(part, part_results):
+					results[i] = result
+			break
+		except (openai.APIError, json.JSONDecodeError, KeyError, TypeError) as e:
+			print(f"  Couldn't get LLM results ({e}). Trying again.")
+			answer_results = None
+			await asyncio.sleep(2 ** retry)
+
+		matched = match_results_by_id(answer_results or [], len(pending_chunk), validate)
+		for j, result in matched.items():
+			results[pending[j]] = result
+
+		# Let the chunk size adapt to how reliable full chunks are. Only the first response
+		# for the full chunk counts; failed requests (e.g. rate limits) say nothing about the size.
+		if answer_results is not None and not recorded:
+			executor.chunk_size.record(len(q_chunk), len(q_chunk) - len(matched))
+			recorded = True
+
+		if answer_results is not None and len(matched) < len(pending_chunk):
+			print(f"  Got valid LLM results for {len(matched)}/{len(pending_chunk)} questions. Trying again for the missing ones.")
+
+		pending = [i for j, i in enumerate(pending) if j not in matched]
+		if not pending:
+			break
+
+	return results
+
+
+async def simplify_chunk(executor: LLMExecutor, q_chunk: list) -> list:
 	"""
 	Simplify and contextualise questions through LLMs.
 
@@ -65,297 +244,738 @@ def simplify_and_contextualise_questions(string: str) -> dict:
 
 	Uses OpenAI.
 	"""
+	return await run_chunk_with_ids(
+		executor, q_chunk, prompts.SIMPLIFY_AND_CONTEXTUALISE, get_simplify_input, validate_simplified)
 
-	prompt = prompts.SIMPLIFY_AND_CONTEXTUALISE
-	answer = get_openai_answer(prompt.replace("[input]", string))
-
-	questions_simple = json.loads(answer)["results"]
-	return questions_simple
 
-
-def score_explicit_question(string: str) -> list:
+async def score_explicit_chunk(executor: LLMExecutor, q_chunk: list) -> list:
 	"""
 	Uses LLMs to score a question based on whether it is considered explicit or implicit.
 
 	Uses OpenAI.
+	"""
+	return await run_chunk_with_ids(executor, q_chunk, prompts.IS_EXPLICIT, get_explicit_input, validate_explicit)
+
 
+async def simplify_and_categorize_chunk(executor: LLMExecutor, q_chunk: list) -> list:
 	"""
+	Simplify, contextualise, extract a subject from, and categorize questions as
+	explicit or implicit, all in one prompt.
 
-	prompt = prompts.IS_EXPLICIT
+	Uses OpenAI.
+	"""
+	return await run_chunk_with_ids(
+		executor, q_chunk, prompts.SIMPLIFY_CONTEXTUALISE_AND_CATEGORISE, get_simplify_input, validate_simplified_and_explicit)
 
-	answer = get_openai_answer(prompt.replace("[input]", string))
 
-	results = json.loads(answer)["results"]
+async def run_llm_stage(questions: list, executor: LLMExecutor, run_chunk, item_tokens, description: str, on_chunk=None) -> list:
+	"""
+	Run an LLM stage over all questions concurrently, with the executor's shared client.
+	Questions are chunked with an adaptive chunk size (see `llm_executor.AdaptiveChunkSize`)
+	and packed up to the token budgets, based on the estimates of `item_tokens`.
+	Returns a result per question (or None if it failed), in the same order as `questions`.
+	"""
+	results = await executor.map_items(questions, run_chunk, item_tokens, description=description, on_chunk=on_chunk)
+
+	llm_cache.print_stats()
 	return results
 
 
-async def get_toxicity_scores_perspective(texts: list) -> list:
+class ToxicityScoringError(Exception):
 	"""
-	Score texts with toxicity scores through Google Jigsaw's Perspective API.
+	Raised when questions couldn't be scored for toxicity, e.g. during a Perspective outage.
 	"""
+	pass
+
+
+PERSPECTIVE_URL = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+PERSPECTIVE_ATTRIBUTES = ["TOXICITY", "SEVERE_TOXICITY", "IDENTITY_ATTACK", "INSULT", "PROFANITY", "THREAT"]
 
-	# Create client
-	api_key = config.GOOGLE_KEY
 
+def is_unscorable(api_response: httpx.Response) -> bool:
+	"""
+	Whether Perspective rejected a text itself (e.g. because of its language), rather than the request.
+	These errors come with a Perspective `errorType`; an invalid API key, for example, doesn't.
+	"""
+	if api_response.status_code != 400:
+		return False
 	try:
-		client = discovery.build(
-			"commentanalyzer",
-			"v1alpha1",
-			developerKey=api_key,
-			discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
-			static_discovery=False
-		)
-	except HttpError as e:
-		error = json.loads(e.content)["error"]["message"]
-		raise Exception(error)
+		details = api_response.json()["error"].get("details", [])
+	except (ValueError, KeyError, AttributeError):
+		return False
+	return any(isinstance(detail, dict) and "errorType" in detail for detail in details)
 
-	results = []
 
-	attributes = ["TOXICITY", "SEVERE_TOXICITY", "IDENTITY_ATTACK", "INSULT", "PROFANITY", "THREAT"]
-	api_attributes = {attribute: {} for attribute in attributes}
+async def get_toxicity_score_perspective(client: httpx.AsyncClient, rate_limiter: TokenBucket, text: str):
+	"""
+	Score a single text through Google Jigsaw's Perspective API.
+	Retries with exponential backoff on rate limits, server errors and network errors.
+
+	Returns None if the text couldn't be scored now (so it's scored again in a later run), and
+	empty scores if Perspective can't score it at all, e.g. because it doesn't support its language.
+	"""
+	analyze_request = {
+		"comment": {"text": text},
+		"requestedAttributes": {attribute: {} for attribute in PERSPECTIVE_ATTRIBUTES},
+		"doNotStore": True
+	}
+
+	max_retries = 5
+	retry_timeout = 2
+	for retry in range(max_retries):
+		await rate_limiter.acquire()
+		try:
+			api_response = await client.post(PERSPECTIVE_URL, params={"key": config.GOOGLE_KEY}, json=analyze_request)
+		except httpx.HTTPError as e:
+			print("  Couldn't score toxicity: ", str(e))
+			await asyncio.sleep(retry_timeout * 2 ** retry)
+			continue
+
+		if api_response.status_code == 429:
+			print("  Exceeded Perspective API rate limit, sleeping and trying again")
+			await asyncio.sleep(retry_timeout * 2 ** retry)
+			continue
+		elif api_response.status_code >= 500:
+			print(f"  Perspective API returned {api_response.status_code}, sleeping and trying again")
+			await asyncio.sleep(retry_timeout * 2 ** retry)
+			continue
+		elif is_unscorable(api_response):
+			# Trying again won't help, so the question is merged without scores
+			print("  Perspective can't score this question: ", api_response.json()["error"].get("message", ""))
+			return {attribute: "" for attribute in PERSPECTIVE_ATTRIBUTES}
+		elif api_response.status_code != 200:
+			print("  Couldn't score toxicity: ", api_response.text)
+			return None
+
+		response = api_response.json()
+		return {attribute: float(response["attributeScores"][attribute]["summaryScore"]["value"]) for attribute in PERSPECTIVE_ATTRIBUTES}
+
+	return None
+
+
+async def get_toxicity_scores_perspective(texts: list, on_scored=None) -> list:
+	"""
+	Score texts with toxicity scores through Google Jigsaw's Perspective API.
+	Requests are sent concurrently, at most `PERSPECTIVE_QPS` per second.
+	`on_scored(positions, results)` is called with every result as it comes in.
+	"""
+	rate_limiter = TokenBucket(config.PERSPECTIVE_QPS, config.PERSPECTIVE_QPS)
+	limits = httpx.Limits(max_connections=max(int(config.PERSPECTIVE_QPS), 1) * 2)
+	done = 0
+
+	async def score(i, text):
+		nonlocal done
+		result = await get_toxicity_score_perspective(client, rate_limiter, text)
+		done += 1
+		print(f"  Scored {done}/{len(texts)} questions with Perspective API")
+		if on_scored:
+			on_scored([i], [result])
+		return result
 
-	i = 0
+	async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+		return await asyncio.gather(*[score(i, text) for i, text in enumerate(texts)])
 
-	for text in texts:
-		analyze_request = {
-			"comment": {"text": text},
-			"requestedAttributes": api_attributes,
-			"doNotStore": True
-		}
 
-		response = None
-		max_retries = 3
-		retries = 0
-		perspective_timeout = config.PERSPECTIVE_TIMEOUT
-		retry_timeout = 10
-		while retries < max_retries:
-			try:
-				response = client.comments().analyze(body=analyze_request).execute()
-				break
-			except HttpError as e:
-				if e.status_code == 429:
-					print("  Exceeded Perspective API rate limit, sleeping and trying again")
-					retries += 1
-					time.sleep(retry_timeout)
-					retry_timeout += 10
-					continue
-				else:
-					print("  Couldn't score toxicity: ", str(e))
-					break
-
-		result = {}
-		for attribute in attributes:
-			if response:
-				result[attribute] = float(response["attributeScores"][attribute]["summaryScore"]["value"])
-			else:
-				result[attribute] = ""
+def parse_moderation_scores(category_scores) -> dict:
+	"""
+	Convert OpenAI moderation category scores to the columns we store.
+	"""
+	result = list(category_scores)
+	clean_result = {"OPENAI_MOD_AVG": sum([r[1] for r in result]) / len([r for r in result])}
+	for r in result:
+		clean_result[r[0].upper()] = round(r[1], 9)
+	return clean_result
+
 
-		results.append(result)
-		i += 1
-		print(f"  Scored {i}/{len(texts)} questions with Perspective API")
+async def get_toxicity_scores_openai_batch(client: openai.AsyncOpenAI, texts: list) -> list:
+	"""
+	Retrieve moderation scores from OpenAI for a batch of texts in one request.
+	Results are returned in the same order as the texts, or are None if the request kept failing.
+	"""
+	for retry in range(config.MAX_OPENAI_RETRIES):
+		try:
+			response = await client.moderations.create(
+				model=config.MODERATION_MODEL,
+				input=texts
+			)
+		except openai.APIError as e:
+			print(f"  Couldn't get moderation scores ({e}). Trying again.")
+			await asyncio.sleep(2 ** retry)
+			continue
 
-		# Don't exceed the rate limit
-		time.sleep(perspective_timeout)
+		return [parse_moderation_scores(result.category_scores) for result in response.results]
 
-	return results
+	print(f"  Couldn't get moderation scores from OpenAI after {config.MAX_OPENAI_RETRIES} tries")
+	return [None] * len(texts)
 
 
-async def get_toxicity_scores_openai(texts: list) -> list:
+async def get_toxicity_scores_openai_as_batch(texts: list, batches: list) -> list:
 	"""
-	Retrieve moderation scores from OpenAI.
+	Retrieve moderation scores through the OpenAI Batch API, with one batch request per batch of texts.
+	Returns the scores per batch, or None for batches that failed.
 	"""
-	client = openai.OpenAI(api_key=config.OPENAI_KEY)
-	score_results = []
+	bodies = [{"model": config.MODERATION_MODEL, "input": [texts[j] for j in batch]} for batch in batches]
+	custom_ids = [openai_batch.get_custom_id("moderation", body) for body in bodies]
+	responses = await openai_batch.run_batch(dict(zip(custom_ids, bodies)), "/v1/moderations", "moderation")
 
-	i = 0
-	for text in texts:
+	batch_results = []
+	for custom_id in custom_ids:
+		try:
+			results = responses[custom_id]["results"]
+			# The raw JSON has category names like "self-harm"; parse them like the SDK does, so we get the same columns
+			batch_results.append([parse_moderation_scores(CategoryScores.model_validate(result["category_scores"])) for result in results])
+		except (KeyError, TypeError, AttributeError, ValueError):
+			batch_results.append(None)
 
-		response = client.moderations.create(
-			model="omni-moderation-latest",
-			input=text
-		)
+	return batch_results
 
-		result = response.results[0].category_scores
-		clean_result = {"OPENAI_MOD_AVG": sum([r[1] for r in result]) / len([r for r in result])}
-		for r in result:
-			clean_result[r[0].upper()] = round(r[1], 9)
-		score_results.append(clean_result)
 
-		i += 1
-		print(f"  Scored {i}/{len(texts)} questions with OpenAI")
-		time.sleep(1)
+async def get_toxicity_scores_openai(texts: list, on_scored=None) -> list:
+	"""
+	Retrieve moderation scores from OpenAI.
+
+	Texts are packed into batches of at most `MODERATION_BATCH_SIZE` texts and `MODERATION_BATCH_CHARS`
+	characters, with `MODERATION_CONCURRENCY` batches in flight.
+	`on_scored(positions, results)` is called with the results of every batch as they come in.
+	"""
+	batches = pack_by_size(texts, config.MODERATION_BATCH_SIZE, config.MODERATION_BATCH_CHARS)
+	semaphore = asyncio.Semaphore(config.MODERATION_CONCURRENCY)
+	done = 0
+
+	async def score(batch):
+		nonlocal done
+		async with semaphore:
+			batch_results = await get_toxicity_scores_openai_batch(client, [texts[i] for i in batch])
+		done += len(batch)
+		print(f"  Scored {done}/{len(texts)} questions with OpenAI")
+		if on_scored:
+			on_scored(batch, batch_results)
+		return batch_results
+
+	async with openai.AsyncOpenAI(api_key=config.OPENAI_KEY) as client:
+		if config.BATCH_MODE:
+			batch_results = await get_toxicity_scores_openai_as_batch(texts, batches)
+			if on_scored:
+				for batch, results in zip(batches, batch_results):
+					if results is not None:
+						on_scored(batch, results)
+
+			# Retry failed batches interactively
+			batch_results = [
+				results if results is not None else await score(batch)
+				for batch, results in zip(batches, batch_results)
+			]
+		else:
+			batch_results = await asyncio.gather(*[score(batch) for batch in batches])
+
+	# Map back to the order of the input texts
+	score_results = [None] * len(texts)
+	for batch, results in zip(batches, batch_results):
+		for i, result in zip(batch, results):
+			score_results[i] = result
 
 	return score_results
 
 
+async def run_llm_stage_as_batch(questions: list, executor: LLMExecutor, prompt: str, get_input, validate, run_chunk, item_tokens, description: str, name: str, on_chunk=None) -> list:
+	"""
+	Run an LLM stage through the OpenAI Batch API, for backfills.
+	Returns a result per question (or None if it failed), in the same order as `questions`.
+
+	Chunks with a cached answer are not submitted. Questions without a valid
+	result in the batch are retried interactively with `run_chunk`.
+	"""
+	q_chunks = pack_items(questions, item_tokens, config.CHUNKS)
+	chunk_prompts = [prompt.replace("[input]", get_input(q_chunk)) for q_chunk in q_chunks]
+	answers = [llm_cache.get(llm_cache.make_key(config.MODEL, chunk_prompt)) for chunk_prompt in chunk_prompts]
+
+	# Custom IDs are derived from the prompts, so a re-run can pick up a batch submitted before
+	bodies = [openai_batch.chat_completion_body(chunk_prompt) for chunk_prompt in chunk_prompts]
+	custom_ids = [openai_batch.get_custom_id(name, body) for body in bodies]
+	batch_requests = {custom_id: body for custom_id, body, answer in zip(custom_ids, bodies, answers) if answer is None}
+	if batch_requests:
+		responses = await openai_batch.run_batch(batch_requests, "/v1/chat/completions", name)
+		for i, custom_id in enumerate(custom_ids):
+			try:
+				answers[i] = responses[custom_id]["choices"][0]["message"]["content"]
+			except (KeyError, IndexError, TypeError):
+				continue
+
+	results = []
+	for q_chunk, chunk_prompt, answer in zip(q_chunks, chunk_prompts, answers):
+		try:
+			answer_results = json.loads(answer)["results"]
+		except (json.JSONDecodeError, KeyError, TypeError):
+			answer_results = []
+
+		matched = match_results_by_id(answer_results, len(q_chunk), validate)
+		if len(matched) == len(q_chunk):
+			llm_cache.put(llm_cache.make_key(config.MODEL, chunk_prompt), answer)
+		results += [matched.get(i) for i in range(len(q_chunk))]
+
+	failed = [i for i, result in enumerate(results) if result is None]
+	if failed:
+		print(f"  Retrying {len(failed)} questions without a valid batch result interactively")
+		retried_results = await run_llm_stage([questions[i] for i in failed], executor, run_chunk, item_tokens, description, on_chunk)
+		for i, result in zip(failed, retried_results):
+			results[i] = result
+
+	return results
+
+
+def get_toxicity_cache_keys() -> dict:
+	"""
+	What determines the toxicity scores per provider. Cached scores are only used if this matches,
+	so changing a model, the attributes, or `TOXICITY_CACHE_VERSION` invalidates them.
+	"""
+	return {
+		"perspective": f"v{config.TOXICITY_CACHE_VERSION}:v1alpha1:{','.join(PERSPECTIVE_ATTRIBUTES)}",
+		"openai": f"v{config.TOXICITY_CACHE_VERSION}:{config.MODERATION_MODEL}"
+	}
+
+
 async def get_toxicity_scores(texts: list) -> list:
-	task_1 = asyncio.create_task(get_toxicity_scores_perspective(texts))
-	task_2 = asyncio.create_task(get_toxicity_scores_openai(texts))
+	"""
+	Get Perspective and OpenAI toxicity scores, in parallel.
+
+	Scores are cached by the normalised text (see `clean_and_hash()`), so only
+	texts we haven't scored before are sent to the APIs. They're cached as they come
+	in, so if scoring is interrupted, the texts that were scored aren't sent again.
+	Scores that failed are None.
+	"""
+	cache_keys = get_toxicity_cache_keys()
+	text_hashes = [clean_and_hash(text) for text in texts]
+
+	scores = {}
+	tasks = {}
+	for provider, scorer in (("perspective", get_toxicity_scores_perspective), ("openai", get_toxicity_scores_openai)):
+		scores[provider] = stores.get_toxicity_scores(provider, cache_keys[provider], text_hashes)
+
+		# One text per hash that isn't cached yet
+		missing = {}
+		for text, text_hash in zip(texts, text_hashes):
+			if text_hash not in scores[provider]:
+				missing.setdefault(text_hash, text)
+
+		def save_scores(positions: list, results: list, provider=provider, missing_hashes=list(missing.keys())):
+			# Don't cache failed requests, so they're sent again. Empty Perspective scores (for texts it
+			# can't score) are cached, so we don't ask again.
+			new_scores = {missing_hashes[i]: result for i, result in zip(positions, results) if result is not None}
+			stores.add_toxicity_scores(provider, cache_keys[provider], new_scores)
+
+		print(f"  Found {len(scores[provider])} cached {provider} scores, scoring {len(missing)} new questions")
+		tasks[provider] = (list(missing.keys()), asyncio.create_task(scorer(list(missing.values()), save_scores)))
 
-	perspective_scores, openai_scores = await asyncio.gather(task_1, task_2)
+	for provider, (missing_hashes, task) in tasks.items():
+		scores[provider].update(zip(missing_hashes, await task))
 
-	toxicity_scores = [{"perspective": perspective_scores[i], "openai": openai_scores[i]} for i in range(len(texts))]
+	toxicity_scores = [{"perspective": scores["perspective"][text_hash], "openai": scores["openai"][text_hash]} for text_hash in text_hashes]
 
 	return toxicity_scores
 
 
-def parse_ops_from_catalog(in_catalog: list) -> list:
+def has_toxicity_scores(toxicity: dict) -> bool:
 	"""
-	Extracts only the relevant OP data from a catalog file.
+	Whether all toxicity scores of a question were retrieved. Perspective leaves the scores empty for
+	texts it can't score (and, before we told these apart, for failed calls).
 	"""
+	return all("" not in scores.values() for scores in toxicity.values())
 
-	ops = []
 
-	for page in in_catalog:
-		for thread in page["threads"]:
-			op = {
-				"id": thread["no"],
-				"timestamp_utc": thread["time"],
-				"title": clean_html(thread.get("sub", "")),
-				"body": clean_html(thread.get("com", "")),
-				"replies": thread["replies"],
-				"board": thread.get("board", "")
-			}
+async def run_checkpointed_stage(questions: list, stage: str, run_stage) -> list:
+	"""
+	Run a processing stage, only for the questions that don't have a saved result for it yet.
 
-			ops.append(op)
+	`run_stage(questions, on_chunk)` returns a result per question (or None if it failed),
+	and may call `on_chunk(chunk, chunk_results)` to save results as they come in. Results are
+	saved by the hash of the original question, so a re-run after a crash or an API outage
+	resumes where the stage stopped. Returns a result per question.
+	"""
+	question_hashes = [q["question_hash_original"] for q in questions]
+	saved_results = stores.get_stage_results(stage, question_hashes)
+	if saved_results:
+		print(f"  Resuming with {len(saved_results)} saved '{stage}' results")
 
-	return ops
+	def save_results(chunk: list, chunk_results: list):
+		results = {q["question_hash_original"]: result for q, result in zip(chunk, chunk_results) if result}
+		stores.add_stage_results(stage, results)
+		saved_results.update(results)
 
+	remaining_questions = [q for q in questions if q["question_hash_original"] not in saved_results]
+	if remaining_questions:
+		remaining_results = await run_stage(remaining_questions, save_results)
 
-def process(catalog_file: str):
+		# Save what wasn't saved per chunk, e.g. the results of a batch
+		unsaved = [(q, result) for q, result in zip(remaining_questions, remaining_results) if q["question_hash_original"] not in saved_results]
+		if unsaved:
+			save_results(*zip(*unsaved))
+
+	return [saved_results.get(question_hash) for question_hash in question_hashes]
+
+
+async def simplify_questions(questions: list, executor: LLMExecutor) -> list:
+	"""
+	SIMPLIFY, CONTEXTUALISE, AND EXTRACT SUBJECT
+	Adds `question_simplified_contextualized` and `subject` to the questions.
+	Returns the questions that were simplified successfully.
 	"""
+	if not questions:
+		return []
+
+	print(f"Simplifying {len(questions)} questions")
+	if config.BATCH_MODE:
+		questions_simple = await run_checkpointed_stage(questions, "simplified", lambda remaining, on_chunk: run_llm_stage_as_batch(
+			remaining, executor, prompts.SIMPLIFY_AND_CONTEXTUALISE, get_simplify_input, validate_simplified,
+			simplify_chunk, get_simplify_tokens, "Simplified", "simplify", on_chunk))
+	else:
+		questions_simple = await run_checkpointed_stage(questions, "simplified", lambda remaining, on_chunk: run_llm_stage(
+			remaining, executor, simplify_chunk, get_simplify_tokens, "Simplified", on_chunk))
 
-	Take a catalog file and run through the whole processing step.
+	# Add to original dataset
+	for question, q_simple in zip(questions, questions_simple):
+		if q_simple:
+			question.update(q_simple)
 
-	Only processes posts that haven't been processed already.
-	Processed IDs are stored in `data/processed_ids.json` and
-	a full list of extracted and manipulated questions will be found in `data/questions.json` and `data/questions.csv`.
+	# Skip questions that kept failing
+	return drop_failed_questions(questions, "question_simplified_contextualized")
 
+
+async def categorize_questions(questions: list, executor: LLMExecutor) -> list:
 	"""
-	catalog = json.load(open(catalog_file))
-	board_name = os.path.basename(catalog_file).split("_")[0]
-	ops = parse_ops_from_catalog(catalog)
+	SCORE EXPLICITNESS
+	Adds `explicit` to the questions.
+	Returns the questions that were categorized successfully.
+	"""
+	if not questions:
+		return []
 
-	# Only keep OPs that generated X replies
-	ops = [op for op in ops if op["replies"] >= config.MIN_REPLIES]
+	print(f"Categorizing whether {len(questions)} questions are explicit or not.")
+	if config.BATCH_MODE:
+		scored_questions = await run_checkpointed_stage(questions, "explicit", lambda remaining, on_chunk: run_llm_stage_as_batch(
+			remaining, executor, prompts.IS_EXPLICIT, get_explicit_input, validate_explicit,
+			score_explicit_chunk, get_explicit_tokens, "Categorized as explicit/implicit", "explicit", on_chunk))
+	else:
+		scored_questions = await run_checkpointed_stage(questions, "explicit", lambda remaining, on_chunk: run_llm_stage(
+			remaining, executor, score_explicit_chunk, get_explicit_tokens, "Categorized as explicit/implicit", on_chunk))
+
+	for question, scored_question in zip(questions, scored_questions):
+		if scored_question:
+			question.update(scored_question)
+
+	return drop_failed_questions(questions, "explicit")
+
+
+async def simplify_and_categorize_questions(questions: list, executor: LLMExecutor) -> list:
+	"""
+	SIMPLIFY, CONTEXTUALISE, EXTRACT SUBJECT, AND SCORE EXPLICITNESS IN ONE PASS
+	Adds `question_simplified_contextualized`, `subject`, and `explicit` to the questions.
+	Used instead of `simplify_questions()` and `categorize_questions()` if `LLM_MODE` is "fused".
+	Returns the questions that were processed successfully.
+	"""
+	if not questions:
+		return []
+
+	print(f"Simplifying and categorizing {len(questions)} questions")
+	if config.BATCH_MODE:
+		results = await run_checkpointed_stage(questions, "simplified_explicit", lambda remaining, on_chunk: run_llm_stage_as_batch(
+			remaining, executor, prompts.SIMPLIFY_CONTEXTUALISE_AND_CATEGORISE, get_simplify_input, validate_simplified_and_explicit,
+			simplify_and_categorize_chunk, get_fused_tokens, "Simplified and categorized", "simplify-explicit", on_chunk))
+	else:
+		results = await run_checkpointed_stage(questions, "simplified_explicit", lambda remaining, on_chunk: run_llm_stage(
+			remaining, executor, simplify_and_categorize_chunk, get_fused_tokens, "Simplified and categorized", on_chunk))
+
+	for question, result in zip(questions, results):
+		if result:
+			question.update(result)
+
+	return drop_failed_questions(questions, "explicit")
+
+
+async def score_toxicity(questions: list) -> list:
+	"""
+	SCORE TOXICITY WITH PERSPECTIVE AND OPENAI
+	Adds `toxicity` to the questions.
+	"""
+	if not questions:
+		return []
+
+	async def score(remaining, on_chunk):
+		toxicity_scores = await get_toxicity_scores([q["question_simplified_contextualized"] for q in remaining])
 
-	# Extract questions
-	for i in range(len(ops)):
-		ops[i]["questions"] = extract_questions(ops[i]["title"] + "\n" + ops[i]["body"])
+		# Scores are cached per text as they come in, so a crash doesn't lose them. Failed scores aren't saved,
+		# so they're scored again when we resume. Questions Perspective can't score are merged with
+		# empty scores, which never pass `MIN_TOXICITY`.
+		return [scores if None not in scores.values() else None for scores in toxicity_scores]
 
-	# Only keep OPs with questions
-	ops = [op for op in ops if op["questions"]]
+	print(f"Scoring {len(questions)} questions with toxicity scores")
+	toxicity_scores = await run_checkpointed_stage(questions, "scored", score)
 
-	# Skip OPs with questions and enough replies that we've processed before
-	processed_ops_json = "data/processed_ids.json"
-	if not os.path.isfile(processed_ops_json):
-		json.dump([], open(processed_ops_json, "w"))
-	processed_ops = json.load(open(processed_ops_json))
-	ops = [op for op in ops if op["id"] not in processed_ops]
+	# Don't merge questions without scores. The catalog stays unprocessed, and the scores
+	# we did get are saved, so running it again resumes from here.
+	failed = sum(scores is None for scores in toxicity_scores)
+	if failed:
+		raise ToxicityScoringError(f"Couldn't get toxicity scores for {failed} of {len(questions)} questions")
 
-	if not ops:
-		return
+	for i in range(len(questions)):
+		questions[i]["toxicity"] = toxicity_scores[i]
 
-	print(f"Processing new {len(ops)} OPs from {board_name}/{catalog_file}")
+	return questions
+
+
+def drop_failed_questions(questions: list, key: str) -> list:
+	"""
+	Remove questions that didn't get a value for `key`, e.g. because the LLM kept returning the wrong number of items.
+	"""
+	kept_questions = [q for q in questions if key in q]
+	if len(kept_questions) != len(questions):
+		print(f"  Skipping {len(questions) - len(kept_questions)} questions without a valid '{key}' value")
+	return kept_questions
+
+
+async def run_api_stages(questions: list, executor: LLMExecutor = None, toxicity_lock: asyncio.Lock = None) -> list:
+	"""
+	Run the LLM stages and toxicity scoring on questions.
+	Returns the questions that made it through all stages.
+
+	Catalogs that are processed at the same time can share an `executor`, so they share
+	its rate limits. Toxicity scoring rate-limits each call on its own, so concurrent
+	callers should share a `toxicity_lock` to take turns.
+	"""
+	if executor is None:
+		async with LLMExecutor() as executor:
+			return await run_api_stages(questions, executor, toxicity_lock)
+
+	if config.LLM_MODE == "fused":
+		questions = await simplify_and_categorize_questions(questions, executor)
+	else:
+		questions = await simplify_questions(questions, executor)
+		questions = await categorize_questions(questions, executor)
+
+	if toxicity_lock is None:
+		return await score_toxicity(questions)
+	async with toxicity_lock:
+		return await score_toxicity(questions)
+
+
+def parse_op(thread: dict) -> dict:
+	"""
+	Extracts only the relevant OP data from a catalog thread.
+	"""
+	return {
+		"id": thread["no"],
+		"timestamp_utc": thread["time"],
+		"title": clean_html(thread.get("sub", "")),
+		"body": clean_html(thread.get("com", "")),
+		"replies": thread["replies"],
+		"board": thread.get("board", "")
+	}
+
+
+def parse_ops_from_catalog(in_catalog: list) -> list:
+	"""
+	Extracts only the relevant OP data from a catalog file.
+	"""
+	return [parse_op(thread) for page in in_catalog for thread in page["threads"]]
+
+
+def skip_processed_threads(threads, board_name: str, batch_size=500):
+	"""
+	Yield the threads we haven't processed before.
+	Threads are looked up in the processed OP index in batches.
+	"""
+	batch = []
+	for thread in threads:
+		batch.append(thread)
+		if len(batch) >= batch_size:
+			processed_ops = stores.get_processed_op_ids(board_name, [t["no"] for t in batch])
+			yield from (t for t in batch if t["no"] not in processed_ops)
+			batch = []
+
+	if batch:
+		processed_ops = stores.get_processed_op_ids(board_name, [t["no"] for t in batch])
+		yield from (t for t in batch if t["no"] not in processed_ops)
+
+
+def extract_catalog(catalog_file: str, skip_op_ids=()) -> dict:
+	"""
+	Get the questions of the OPs in a catalog snapshot that we haven't processed before.
+	This is the CPU-bound part of `process()`, and doesn't write anything.
+
+	OPs in `skip_op_ids` are skipped too, e.g. OPs of earlier snapshots that are
+	being processed in the same run but aren't marked as processed yet.
+
+	Returns a dict with the board name, the IDs of the new OPs (with questions or not),
+	and a dict *per question*.
+	"""
+	board_name = os.path.basename(catalog_file).split("_")[0]
+
+	# Stream threads through the filters, so we never convert the HTML of threads we skip
+	threads = catalog_store.iter_snapshot_threads(catalog_file)
+
+	# Only keep OPs that generated X replies
+	threads = (thread for thread in threads if thread["replies"] >= config.MIN_REPLIES)
+
+	# Skip OPs with enough replies that we've processed before
+	threads = (thread for thread in threads if thread["no"] not in skip_op_ids)
+	threads = skip_processed_threads(threads, board_name)
 
 	# Create a dictionary *per question* instead of per OP
+	new_op_ids = []
+	ops_with_questions = 0
 	questions = []
-	for op in ops:
-		for question in op["questions"]:
-			# Use the original data
-			q_op = op.copy()
-			q_op["question"] = question
-			# Remove *all* questions
-			if "questions" in q_op:
-				del q_op["questions"]
-			questions.append(q_op)
-
-	# Get rid of overly long questions that mess up the token length
-	questions = [q for q in questions if len(q["question"]) < config.MAX_QUESTION_LENGTH]
-	print(f"  {len(questions)} questions extracted")
+	for op in (parse_op(thread) for thread in threads):
+		new_op_ids.append(op["id"])
+		op_questions = extract_questions(op["title"] + "\n" + op["body"])
+		if op_questions:
+			ops_with_questions += 1
 
-	if not questions:
-		return
+		# Get rid of overly long questions that mess up the token length
+		questions += [{**op, "question": question} for question in op_questions if len(question) < config.MAX_QUESTION_LENGTH]
+
+	if ops_with_questions:
+		print(f"Processing new {ops_with_questions} OPs from {board_name}/{catalog_file}")
+		print(f"  {len(questions)} questions extracted")
 
 	# Slice if we're debugging
 	if config.DEBUG_LENGTH:
 		questions = questions[:config.DEBUG_LENGTH]
 
-	# SIMPLIFY, CONTEXTUALISE, AND EXTRACT SUBJECT
-	print(f"Simplifying {len(questions)} questions")
-	i = 0
-	for q_chunk in chunker(questions, config.CHUNKS):
+	# Questions with the same normalised text and OP text get the same LLM and toxicity results, but only
+	# within the same OP text: the LLM resolves pronouns ("Is he right?") from the OP, so the
+	# same question in a different OP can get a different rewrite. Copypasta repeats the whole
+	# OP, so it's still only sent once.
+	for question in questions:
+		question["question_hash_original"] = clean_and_hash(question["question"] + "\n" + question["title"] + "\n" + question["body"])
 
-		retries = 0
+	return {"catalog_file": catalog_file, "board": board_name, "new_op_ids": new_op_ids, "questions": questions}
 
-		# Keep looping until we have the same amount of input v output results
-		while retries < config.MAX_OPENAI_RETRIES:
-			questions_flat = json.dumps([
-				{
-					"question": q["question"],
-					"full_text": q["title"] + "\n" + q["body"]
-				} for q in q_chunk])
 
-			questions_simple = simplify_and_contextualise_questions(questions_flat)
+def get_new_questions(questions: list, known_hashes) -> list:
+	"""
+	One question per normalised question and OP text that isn't in `known_hashes`, in order of appearance.
+	"""
+	new_questions = {}
+	for question in questions:
+		if question["question_hash_original"] not in known_hashes:
+			new_questions.setdefault(question["question_hash_original"], question)
 
-			# Check if the input and output length is the same
-			if len(questions_simple) != len(q_chunk):
-				print(f"  The LLM output is not the same length as the input ({len(questions_simple)} vs {len(q_chunk)}). Trying again.")
-				retries += 1
-				continue
+	return list(new_questions.values())
 
-			# Add to original dataset
-			for q_simple in questions_simple:
-				questions[i]["question_simplified_contextualized"] = q_simple["question_simplified_contextualized"]
-				subject = q_simple.get("subject", "")
-				if subject:
-					questions[i]["subject"] = subject.lower().strip()
-				else:
-					questions[i]["subject"] = ""
-				i += 1
-
-			print(f"  Simplified {i}/{len(questions)} questions")
-			break
 
-		time.sleep(1)
+def get_known_results(question_hashes) -> dict:
+	"""
+	Stored API results for original questions, by their hash. Results with failed toxicity
+	scores (stored before we checked for these) are left out, so those questions are scored again.
+	"""
+	known_results = stores.get_question_results(question_hashes)
+	return {question_hash: result for question_hash, result in known_results.items() if has_toxicity_scores(result["toxicity"])}
 
-	# SCORE EXPLICITNESS
-	print(f"Categorizing whether {len(questions)} questions are explicit or not.")
-	i = 0
-	for q_chunk in chunker(questions, config.CHUNKS):
 
-		retries = 0
+def get_question_results(questions: list) -> dict:
+	"""
+	What the API stages added to questions, by the hash of the original question.
+	"""
+	return {q["question_hash_original"]: {k: q[k] for k in QUESTION_RESULT_KEYS} for q in questions}
 
-		while retries < config.MAX_OPENAI_RETRIES:
 
-			questions_flat = "\n".join([q.get("question_simplified_contextualized", "") for q in q_chunk])
-			scored_questions = score_explicit_question(questions_flat)
+def process(catalog_file: str):
+	"""
 
-			# Check if the input v output length is the same
-			if len(scored_questions) != len(q_chunk):
-				print(
-					f"  The LLM output is not the same length as the input ({len(scored_questions)} vs {len(q_chunk)}). Trying again.")
-				retries += 1
-				continue
+	Take a catalog snapshot and run through the whole processing step.
+	Snapshots are rebuilt from the delta store in `catalog_store.py`.
 
-			for scored_question in scored_questions:
-				questions[i]["explicit"] = scored_question["explicit"]
-				i += 1
+	Only processes posts that haven't been processed already.
+	Processed IDs are stored in the pipeline database (see `stores.py`) and
+	a full list of extracted and manipulated questions is stored in the same database.
 
-			print(f"  Categorized {i}/{len(questions)} questions as explicit/implicit")
-			break
+	The extracted questions and the results of each stage are saved as they come in,
+	so if processing is interrupted, running it again resumes where it stopped.
 
-	# SCORE TOXICITY WITH PERSPECTIVE AND OPENAI
-	print(f"Scoring {len(questions)} questions with toxicity scores")
-	questions_input = [q["question_simplified_contextualized"] for q in questions]
+	Returns a list of the catalog-specific output files.
+	See `parallel_runner.py` for processing many catalogs at once.
 
-	toxicity_scores = asyncio.run(get_toxicity_scores(questions_input))
+	"""
+	extracted = stores.get_extracted_catalog(catalog_file)
+	if extracted:
+		print(f"Resuming {catalog_file} with {len(extracted['questions'])} saved questions")
+	else:
+		extracted = extract_catalog(catalog_file)
+		if extracted["questions"]:
+			stores.save_extracted_catalogs([extracted])
 
-	for i in range(len(questions)):
-		questions[i]["toxicity"] = toxicity_scores[i]
+	questions = extracted["questions"]
+
+	if not questions:
+		stores.add_processed_op_ids(extracted["board"], extracted["new_op_ids"])
+		return []
+
+	# DEDUPLICATE
+	# Questions with the same normalised text and OP text get the same LLM and toxicity results,
+	# so only send questions to the APIs that we haven't seen before (in this batch or earlier runs).
+	known_results = get_known_results(set(q["question_hash_original"] for q in questions))
+	new_questions = get_new_questions(questions, known_results)
+	print(f"  {len(questions) - len(new_questions)} questions are duplicates or were seen before, {len(new_questions)} are new")
+
+	new_questions = asyncio.run(run_api_stages(new_questions))
+
+	# Reuse the results for all questions with the same normalised text and OP text
+	new_results = get_question_results(new_questions)
+	known_results.update(new_results)
+
+	return merge_catalog(extracted, known_results, new_results)
+
+
+def add_occurrence(question: dict, occurrence: dict, board_name: str):
+	"""
+	Add an occurrence of a question to the aggregates of its merged record, without going over
+	earlier occurrences. The occurrence itself is stored with `stores.add_question_occurrences()`.
+
+	The most-occurring subject and 'explicit' label are kept up to date with running counts
+	(these may slightly differ because of LLM extraction). On a tie, the current one stays.
+	"""
+	# Add occurrences per board, and to the total
+	question[board_name + "_count"] = question.get(board_name + "_count", 0) + 1
+	question["count"] += 1
+
+	# Add to reply count
+	question["replies"] += occurrence["replies"]
+
+	# Add to subjects, and take the most-occurring subject as the main one
+	subject_counts = question["subject_counts"]
+	subject_counts[occurrence["subject"]] = subject_counts.get(occurrence["subject"], 0) + 1
+	if subject_counts[occurrence["subject"]] > subject_counts.get(question["subject"], 0):
+		question["subject"] = occurrence["subject"]
+
+	# Same for 'explicit'. JSON object keys are strings, so the labels are stored as JSON.
+	explicit_counts = question["explicit_counts"]
+	explicit_key = json.dumps(occurrence["explicit"])
+	explicit_counts[explicit_key] = explicit_counts.get(explicit_key, 0) + 1
+	if explicit_counts[explicit_key] > explicit_counts.get(json.dumps(question["explicit"]), 0):
+		question["explicit"] = occurrence["explicit"]
+
+	# When the question was first and last seen
+	question["first_seen"] = min(question["first_seen"], occurrence["timestamp_utc"])
+	question["last_seen"] = max(question["last_seen"], occurrence["timestamp_utc"])
+
+
+def merge_catalog(extracted: dict, results: dict, new_results: dict) -> list:
+	"""
+	Add the API results to the questions of an extracted catalog, save them as catalog-specific
+	files, and merge them into the question store.
+
+	`results` holds the API results by the hash of the original question (questions
+	without a result are left out), and `new_results` the ones that aren't stored yet.
+	Marks the OPs of the catalog as processed and returns the catalog-specific output files.
+	"""
+	board_name = extracted["board"]
+	questions = [{**q, **results[q["question_hash_original"]]} for q in extracted["questions"] if q["question_hash_original"] in results]
+
+	if not questions:
+		stores.delete_checkpoints(extracted["catalog_file"], [])
+		return []
 
 	# SAVE AS CATALOG-SPECIFIC JSON AND CSV
-	catalog_filename = catalog_file[:-5] + "_questions"
+	catalog_filename = catalog_store.snapshot_name(extracted["catalog_file"]) + "_questions"
 	with open(f"{catalog_filename}.json", "w", encoding="utf-8") as out_json:
 		json.dump(questions, out_json)
 	df = pd.DataFrame(questions)
@@ -363,93 +983,76 @@ def process(catalog_file: str):
 
 	# THEN MERGE WITH PROCESSED DATA AND RANK
 
-	# Also save a JSON and CSV on *all* questions
-	questions_json_file = f"data/questions.json"
-	questions_csv_file = f"data/questions.csv"
-
-	all_questions = {}
-	if os.path.isfile(questions_json_file):
-		all_questions = json.load(open(questions_json_file, "r"))
-
 	# Get a hash of the simplified question minus special characters as a key.
 	# This way we can better group and count the questions.
-	questions_hashed = {clean_and_hash(q["question_simplified_contextualized"]): q for q in questions}
+	# Near-duplicates (e.g. slightly different LLM wording) get the key of the first question
+	# of their cluster, so they're counted as one question (see `near_duplicates.py`).
+	# Several OPs of one catalog can ask the same question, so keep all of them.
+	questions_hashed = {}
+	for q in questions:
+		question_hash = near_duplicates.get_cluster(clean_and_hash(q["question_simplified_contextualized"]), q["question_simplified_contextualized"])
+		questions_hashed.setdefault(question_hash, []).append(q)
+
+	# Only load the questions we're updating, and which of these OPs they were already seen in
+	all_questions = stores.get_questions(questions_hashed.keys())
+	seen_occurrences = stores.get_known_occurrences(
+		(question_hash, board_name, q["id"]) for question_hash, hashed_questions in questions_hashed.items() for q in hashed_questions)
+	occurrences = []
 
 	board_counts = {board + "_count": 0 for board in list(config.CATALOGS.keys())}
 	board_counts[board_name + "_count"] = 1
 
 	# Merge new questions with old questions.
 	# Update stuff like reply counts.
-	for question_hash, question in questions_hashed.items():
-
-		# New question
-		if question_hash not in all_questions:
-
-			all_questions[question_hash] = {
-				"hash": question_hash,
-				"question_simplified_contextualized": question["question_simplified_contextualized"],
-				"url_google": query_to_search_url(question["question_simplified_contextualized"], search_engine="google"),
-				"url_bing": query_to_search_url(question["question_simplified_contextualized"], search_engine="bing"),
-				"count": 1,
-				"replies": question["replies"],
-				**board_counts,
-				"subject": question["subject"],
-				"subjects_all": [question["subject"]],
-				"explicit": question["explicit"],
-				"explicit_all": [question["explicit"]],
-				"questions_original": [question["question"]],
-				"ids": [question["id"]],
-				"timestamps": [question["timestamp_utc"]],
-				**[question["toxicity"]["perspective"]][0],
-				**[question["toxicity"]["openai"]][0]
-			}
-
-		# Already-encountered question. Update some data!
-		else:
-
-			# Add some question data to existing data
-			old_question = all_questions[question_hash]
+	for question_hash, hashed_questions in questions_hashed.items():
+		for question in hashed_questions:
 
 			# If it's from the same post ID for some reason, just skip
-			if question["id"] in old_question["ids"]:
+			occurrence_key = (question_hash, board_name, question["id"])
+			if occurrence_key in seen_occurrences:
 				continue
+			seen_occurrences.add(occurrence_key)
+			occurrences.append((*occurrence_key, question["timestamp_utc"], question["question"], question["subject"], question["explicit"]))
+
+			# New question
+			if question_hash not in all_questions:
+
+				all_questions[question_hash] = {
+					"hash": question_hash,
+					"question_simplified_contextualized": question["question_simplified_contextualized"],
+					"url_google": query_to_search_url(question["question_simplified_contextualized"], search_engine="google"),
+					"url_bing": query_to_search_url(question["question_simplified_contextualized"], search_engine="bing"),
+					"count": 1,
+					"replies": question["replies"],
+					**board_counts,
+					"subject": question["subject"],
+					"subject_counts": {question["subject"]: 1},
+					"explicit": question["explicit"],
+					"explicit_counts": {json.dumps(question["explicit"]): 1},
+					"first_seen": question["timestamp_utc"],
+					"last_seen": question["timestamp_utc"],
+					**[question["toxicity"]["perspective"]][0],
+					**[question["toxicity"]["openai"]][0]
+				}
+
+			# Already-encountered question. Update some data!
+			else:
+				add_occurrence(all_questions[question_hash], question, board_name)
 
-			# Add occurrences per board
-			old_question[board_name + "_count"] += 1
-
-			# Sum into total occurrences
-			old_question["count"] = sum([v for k, v in old_question.items() if k.endswith("_count")])
-
-			# Add to reply count
-			old_question["replies"] += question["replies"]
-
-			# Add to subjects, and take the most-occurring subject as the main
-			# one (these may slightly differ because of LLM extraction)
-			old_question["subjects_all"].append(question["subject"])
-			old_question["subject"] = Counter(old_question["subjects_all"]).most_common(1)[0][0]
-
-			# Same for 'explicit'
-			old_question["explicit_all"].append(question["explicit"])
-			old_question["explicit"] = Counter(old_question["explicit_all"]).most_common(1)[0][0]
-
-			# Other metadata
-			old_question["questions_original"].append(question["question"])
-			old_question["ids"].append(question["id"])
-			old_question["timestamps"].append(question["timestamp_utc"])
-
-			all_questions[question_hash] = old_question
+				# Fill in toxicity scores that failed when the question was first seen
+				if stores.get_toxicity(all_questions[question_hash]) is None and has_toxicity_scores(question["toxicity"]):
+					all_questions[question_hash].update({**question["toxicity"]["perspective"], **question["toxicity"]["openai"]})
 
 	# Perspective API is deterministic so should remain the same
 
-	# Save as JSON *and* CSV
-	with open(questions_json_file, "w", encoding="utf-8") as out_json:
-		json.dump(all_questions, out_json)
-
-	df = pd.DataFrame(all_questions.values())
-	df.to_csv(questions_csv_file, index=False)
-
-	# Save what IDs we've processed (with valid questions or not)
-	op_ids = [op["id"] for op in ops]
-	processed_ids = list(set(processed_ops + op_ids))
-	with open(processed_ops_json, "w") as out_json:
-		json.dump(processed_ids, out_json)
\ No newline at end of file
+	# Save the updated questions and what IDs we've processed (with valid questions or not) in one transaction.
+	# Use `stores.export_questions()` to get a JSON and CSV of all questions.
+	with stores.get_db():
+		stores.upsert_questions(all_questions, commit=False)
+		stores.add_question_occurrences(occurrences, commit=False)
+		# Results with failed toxicity scores aren't reused, so the question is scored again when it's seen again
+		stores.add_question_results({h: r for h, r in new_results.items() if has_toxicity_scores(r["toxicity"])}, commit=False)
+		stores.add_processed_op_ids(board_name, extracted["new_op_ids"], commit=False)
+		stores.delete_checkpoints(extracted["catalog_file"], [q["question_hash_original"] for q in extracted["questions"]], commit=False)
+
+	return [f"{catalog_filename}.json", f"{catalog_filename}.csv"]
\ No newline at end of file
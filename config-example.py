@@ -4,6 +4,14 @@ CATALOGS = {
 	"4chan/pol/": "https://a.4cdn.org/pol/catalog.json"
 }
 
+# Catalog collection
+MAX_CONNECTIONS_PER_HOST = 4	# How many catalogs we request from the same host at once
+CATALOG_TIMEOUT = 30		# Seconds before a catalog request times out
+SNAPSHOT_REBASE_EVERY = 100	# After how many delta snapshots we save a full base snapshot again
+
+# SQLite database with processed OPs and other pipeline state
+DATABASE_FILE = "data/radical-serp-searcher.db"
+
 # What search engines we should consider
 SEARCH_ENGINES = ["google", "bing"]
 
@@ -13,18 +21,43 @@ MIN_REPLIES = 100			# The minimum number of replies the OP must have received
 MUST_BE_EXPLICIT = True		# Whether the question should be labeled as 'explicit' by the LLM
 MIN_TOXICITY = 0.2			# Threshold for toxicity score
 MAX_QUESTION_LENGTH = 500	# How many characters a single question may be (long questions are expensive and maybe not worth it
+NEAR_DUPLICATE_THRESHOLD = 0		# Simplified questions with at least this share of the same content words and word pairs are counted as one (0: only group identical questions). Choose it with `python -m benchmarks.near_duplicates`; 0.8 merges no different questions in its labelled pairs
 
 # LLM / OpenAI stuff
 MODEL = "gpt-4o-mini"		# See https://platform.openai.com/docs/models/
 OPENAI_KEY = "XXX"
 TEMPERATURE = 0.1
 MAX_OUTPUT_TOKENS = 4096
-CHUNKS = 3					# Smaller is more reliable but more expensive.
-MAX_OPENAI_RETRIES = 5		# How many times we retry the prompt if the input and output length are not the same.
+CHUNKS = 3					# Questions per prompt. Smaller is more reliable but more expensive. This is the starting size; it adapts to how often the LLM misses items.
+MAX_CHUNKS = 25				# The number of questions per prompt won't grow beyond this
+CHUNK_INPUT_TOKENS = 6000	# Prompts are filled with questions (and their OP text) up to this many tokens
+MAX_OPENAI_RETRIES = 5		# How many times we retry questions the LLM didn't return a valid result for.
+OPENAI_CONCURRENCY = 8		# How many chunks we send to OpenAI at the same time
+OPENAI_RPM = 500			# Requests per minute limit of your OpenAI account
+OPENAI_TPM = 200000			# Tokens per minute limit of your OpenAI account
+LLM_MODE = "separate"		# "separate": simplify and categorize questions in two passes. "fused": do both in one prompt.
+BATCH_MODE = False			# Use the OpenAI Batch API (cheaper, but can take up to 24 hours). Useful for backfills: all unprocessed catalogs go into one batch per stage.
+BATCH_DIR = "data/batches"	# Where JSONL batch files are written
+BATCH_POLL_INTERVAL = 60	# Seconds between checking whether a batch is done
+BATCH_MAX_REQUESTS = 50000	# Maximum number of requests per batch file
+BATCH_MAX_BYTES = 190 * 1024 * 1024	# Maximum size of a batch file (OpenAI accepts up to 200 MB)
+LLM_CACHE = True			# Whether to cache LLM responses, so the same prompts aren't sent twice
+LLM_CACHE_FILE = "data/llm_cache.db"
+LLM_CACHE_MAX_SIZE_MB = 500
+LLM_CACHE_MAX_AGE_DAYS = 90
+
+# OpenAI moderation scores
+MODERATION_MODEL = "omni-moderation-latest"
+MODERATION_BATCH_SIZE = 32	# How many texts we send per moderation request
+MODERATION_BATCH_CHARS = 32000	# Maximum number of characters per moderation request
+MODERATION_CONCURRENCY = 4	# How many moderation requests we send at the same time
+
+# Increase this to score all questions again instead of using cached toxicity scores
+TOXICITY_CACHE_VERSION = 1
 
 # Google Perspective API key
 GOOGLE_KEY = "XXX"
-PERSPECTIVE_TIMEOUT = 2.5
+PERSPECTIVE_QPS = 1			# Queries per second quota of your Google Cloud project for the Perspective API
 
 # 4CAT token
 TOKEN_4CAT = "XXX"
@@ -37,7 +70,12 @@ URL_4CAT = "XXX"
 # What to execute
 COLLECT_CATALOGS = False
 PROCESS_QUESTIONS = False
+PROCESS_WORKERS = 1			# Processes for extracting questions from catalogs. With more than one, boards are processed in parallel.
 TAKE_SCREENSHOTS = False
+SCREENSHOT_NEW_ONLY = False	# Only take screenshots of questions that were seen again since their last screenshots
+EXPORT_QUESTIONS = False	# Export all questions, see EXPORT_FORMAT
+EXPORT_FORMAT = "parquet"	# "parquet": update the questions that changed in PARQUET_DIR. "csv": rewrite data/questions.json and data/questions.csv.
+PARQUET_DIR = "data/questions.parquet"	# Parquet export, partitioned by board and month (read it with `parquet_store.read_questions()`)
 
 # Selenium settings
 SELENIUM_WAIT_TIME = 6
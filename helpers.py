@@ -1,12 +1,16 @@
 import os
 import openai
+import html
+import html.entities
 import html2text
 import hashlib
 import re
 
-from typing import Generator
+from html2text.config import UNIFIABLE
+from html2text.utils import escape_md, escape_md_section, unifiable_n
 
 import config
+import llm_cache
 
 
 def make_dirs():
@@ -22,37 +26,61 @@ def make_dirs():
 			os.mkdir("data/catalogs/" + board)
 
 
-def questions_above_thresholds(questions: dict) -> dict:
+def pack_by_size(items: list, max_items: int, max_size: int, size=len) -> list:
 	"""
-	Returns questions above the threshold set in config.py.
+	Pack items into batches of at most `max_items` items and a total `size()` of at most `max_size`.
+	Items that are larger than `max_size` get a batch of their own.
+
+	Returns the batches as lists of indexes of `items`, so results can be mapped back.
 	"""
+	batches = []
+	batch = []
+	batch_size = 0
+
+	for i, item in enumerate(items):
+		item_size = size(item)
+		if batch and (len(batch) >= max_items or batch_size + item_size > max_size):
+			batches.append(batch)
+			batch = []
+			batch_size = 0
+		batch.append(i)
+		batch_size += item_size
 
-	print("Filtering questions for those above the set thresholds")
-	print(f"  {len(questions)} questions before filtering")
+	if batch:
+		batches.append(batch)
 
-	questions = {k: v for k, v in questions.items() if
-				 v["count"] >= config.QUESTION_THRESHOLD and
-				(v["explicit"] if config.MUST_BE_EXPLICIT else True)
-				 and v["TOXICITY"] >= config.MIN_TOXICITY}
+	return batches
 
-	print(f"  {len(questions)} questions after filtering")
-	return questions
 
+_openai_client = None
 
-def chunker(seq: list, size: int) -> Generator:
+
+def get_openai_client() -> openai.OpenAI:
 	"""
-	Used for feeding data in chunks to LLMs.
+	Get a shared OpenAI client, so we reuse its connections.
 	"""
-	return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+	global _openai_client
+	if _openai_client is None:
+		_openai_client = openai.OpenAI(api_key=config.OPENAI_KEY)
+	return _openai_client
 
 
-def get_openai_answer(prompt: str, response_format="json_object", model=None):
-	# initiate
-	client = openai.OpenAI(api_key=config.OPENAI_KEY)
+def get_openai_answer(prompt: str, response_format="json_object", model=None, refresh=False):
+	"""
+	Get an answer from OpenAI. See `llm_executor.LLMExecutor` for sending many prompts concurrently.
+	Answers are cached; use `refresh` to skip the cache lookup.
+	"""
+	client = get_openai_client()
 
 	if not model:
 		model = config.MODEL
 
+	cache_key = llm_cache.make_key(model, prompt, response_format)
+	if not refresh:
+		cached_answer = llm_cache.get(cache_key)
+		if cached_answer is not None:
+			return cached_answer
+
 	# Get response
 	response = client.chat.completions.create(
 		model=model,
@@ -65,7 +93,10 @@ def get_openai_answer(prompt: str, response_format="json_object", model=None):
 		}]
 	)
 
-	return response.choices[0].message.content
+	answer = response.choices[0].message.content
+	llm_cache.put(cache_key, answer)
+
+	return answer
 
 
 def clean_and_hash(input_string: str) -> str:
@@ -83,10 +114,11 @@ def clean_and_hash(input_string: str) -> str:
 	return hex_dig
 
 
-def clean_html(html_string: str) -> str:
+def clean_html_html2text(html_string: str) -> str:
 	"""
-	Clean up a HTML string.
+	Clean up a HTML string with html2text.
 	"""
+	# A converter keeps state (open tags, pending spaces) between documents, so use a new one every time
 	h = html2text.HTML2Text()
 
 	# Don't wrap lines!
@@ -100,6 +132,173 @@ def clean_html(html_string: str) -> str:
 	return cleaned
 
 
+# Tags and character references in imageboard comments.
+# Anything else (like `<b>` or unquoted attributes) is left to html2text.
+COMMENT_TOKEN = re.compile(r"""
+	<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:\s+[a-zA-Z_:-]+="[^"<>]*")*)\s*(/?)>	# tag
+	|&(\#[0-9]+|\#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);			# character reference
+""", re.VERBOSE)
+COMMENT_ATTRIBUTE = re.compile(r'([a-zA-Z_:-]+)="([^"<>]*)"')
+COMMENT_WHITESPACE = re.compile(r"\s+")
+# Whitespace that needs collapsing, i.e. anything but single spaces
+COMMENT_COLLAPSIBLE_WHITESPACE = re.compile(r"\s\s|[^\S ]")
+MARKDOWN_SPECIAL = re.compile(r"[\\.+-]")
+ABSOLUTE_URL = re.compile(r"^[a-zA-Z+]+://")
+
+# html2text keeps `&nbsp;` out of the whitespace collapsing with a placeholder, and so do we
+NBSP_PLACEHOLDER = "&nbsp_place_holder;"
+
+
+def decode_character_reference(name: str) -> str:
+	"""
+	Decode a character reference the way html2text does, e.g. `&eacute;` becomes `e`.
+	"""
+	if name[0] == "#":
+		codepoint = int(name[2:], 16) if name[1] in "xX" else int(name[1:])
+		if codepoint in unifiable_n:
+			return unifiable_n[codepoint]
+		try:
+			return chr(codepoint)
+		except (ValueError, OverflowError):
+			return ""
+
+	if name == "nbsp":
+		return NBSP_PLACEHOLDER
+	if name in UNIFIABLE:
+		return UNIFIABLE[name]
+	return html.entities.html5.get(name + ";", "&" + name + ";")
+
+
+def clean_comment_html(html_string: str):
+	"""
+	Convert an imageboard comment to the same text as `clean_html_html2text()`, without
+	running the full Markdown renderer.
+
+	Handles line breaks, character references, greentext and other spans, and (quote)links.
+	Returns None if the comment contains anything else.
+	"""
+	out = []
+	space = False
+	started = False
+
+	# Link that's open, and whether it may still be written as an automatic link (`<url>`)
+	link = None
+	automatic_link = None
+	empty_link = False
+
+	def write(data: str, puredata=True):
+		nonlocal space, started
+		if puredata:
+			if COMMENT_COLLAPSIBLE_WHITESPACE.search(data):
+				data = COMMENT_WHITESPACE.sub(" ", data)
+			if data and data[0] == " ":
+				space = True
+				data = data[1:]
+			if not data:
+				return
+
+		if not started:
+			space = False
+			started = True
+
+		if space:
+			if out and not out[-1].endswith("\n"):
+				out.append(" ")
+			space = False
+
+		out.append(data)
+
+	def write_text(data: str, escape=True):
+		nonlocal automatic_link, empty_link
+		if not data:
+			return
+
+		if automatic_link is not None:
+			if data == automatic_link and ABSOLUTE_URL.match(data):
+				write("<" + data + ">", puredata=False)
+				empty_link = False
+				return
+			write("[", puredata=False)
+			automatic_link = None
+			empty_link = False
+
+		if escape and MARKDOWN_SPECIAL.search(data):
+			data = escape_md_section(data)
+		write(data)
+
+	pos = 0
+	for token in COMMENT_TOKEN.finditer(html_string):
+		text = html_string[pos:token.start()]
+		if "<" in text or "&" in text:
+			return None
+		write_text(text)
+		pos = token.end()
+
+		is_end, tag, attributes, self_closing, reference = token.groups()
+		if reference:
+			write_text(decode_character_reference(reference), escape=False)
+			continue
+
+		# A tag right at the start of a link means it's not an automatic link
+		if not is_end and automatic_link is not None:
+			write("[", puredata=False)
+			automatic_link = None
+			empty_link = False
+
+		tag = tag.lower()
+		if tag in ("br", "wbr"):
+			if is_end:
+				return None
+			if tag == "br":
+				write("  \n", puredata=False)
+		elif tag == "span" and not self_closing:
+			pass
+		elif tag == "a" and not self_closing:
+			if not is_end:
+				if link is not None:
+					return None
+				link = {k.lower(): html.unescape(v) for k, v in COMMENT_ATTRIBUTE.findall(attributes)}
+				if "href" in link and not link["href"].startswith("#"):
+					automatic_link = link["href"]
+					empty_link = True
+				else:
+					link = {}
+			elif link is not None:
+				if automatic_link and not empty_link:
+					automatic_link = None
+				elif link:
+					if empty_link:
+						write("[", puredata=False)
+						empty_link = False
+						automatic_link = None
+					title = escape_md(link.get("title") or "")
+					title = f' "{title}"' if title.strip() else ""
+					write("](" + escape_md(link["href"]) + title + ")", puredata=False)
+				link = None
+		else:
+			return None
+
+	text = html_string[pos:]
+	if "<" in text or "&" in text:
+		return None
+	write_text(text)
+
+	out.append("\n")
+	return "".join(out).replace(NBSP_PLACEHOLDER, " ")
+
+
+def clean_html(html_string: str) -> str:
+	"""
+	Clean up a HTML string.
+	Most imageboard comments take the fast path; the rest is converted with html2text.
+	"""
+	cleaned = clean_comment_html(html_string)
+	if cleaned is None:
+		cleaned = clean_html_html2text(html_string)
+
+	return cleaned
+
+
 def query_to_search_url(query: str, search_engine="google") -> str:
 	"""
 	Converts a string query to a search engine query URL
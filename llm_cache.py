@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache for LLM responses.
+
+The same OP text shows up in many consecutive catalog snapshots, so the same
+prompts are sent to OpenAI over and over. Responses are stored in a SQLite
+database keyed by a hash of the model, the generation settings, and the full
+prompt (i.e. the prompt template with the input filled in).
+
+Entries older than `LLM_CACHE_MAX_AGE_DAYS` are removed, and the least recently
+used entries are removed when the cache grows over `LLM_CACHE_MAX_SIZE_MB`.
+"""
+import time
+import json
+import hashlib
+import sqlite3
+
+import config
+
+_connection = None
+
+# Hits and misses in this run
+stats = {"hits": 0, "misses": 0}
+
+
+def get_db() -> sqlite3.Connection:
+	global _connection
+
+	if _connection is None:
+		_connection = sqlite3.connect(config.LLM_CACHE_FILE)
+		_connection.execute("PRAGMA journal_mode=WAL")
+		_connection.execute("PRAGMA synchronous=NORMAL")
+		with _connection:
+			_connection.execute("""
+				CREATE TABLE IF NOT EXISTS responses (
+					key TEXT PRIMARY KEY,
+					response TEXT NOT NULL,
+					size INTEGER NOT NULL,
+					created_at INTEGER NOT NULL,
+					last_used_at INTEGER NOT NULL
+				) WITHOUT ROWID
+			""")
+			_connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used_at)")
+		evict(_connection)
+
+	return _connection
+
+
+def make_key(model: str, prompt: str, response_format="json_object") -> str:
+	"""
+	Hash of everything that determines the LLM response.
+	"""
+	key = json.dumps([model, config.TEMPERATURE, config.MAX_OUTPUT_TOKENS, response_format, prompt])
+	return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get(key: str):
+	"""
+	Get a cached response, or None if it's not in the cache.
+	"""
+	if not config.LLM_CACHE:
+		return None
+
+	db = get_db()
+	row = db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+
+	if not row:
+		stats["misses"] += 1
+		return None
+
+	stats["hits"] += 1
+	with db:
+		db.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (int(time.time()), key))
+	return row[0]
+
+
+def put(key: str, response: str):
+	"""
+	Add a response to the cache, replacing an existing one with the same key.
+	"""
+	if not config.LLM_CACHE or not response:
+		return
+
+	db = get_db()
+	now = int(time.time())
+	with db:
+		db.execute(
+			"INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+			(key, response, len(response.encode("utf-8")), now, now)
+		)
+
+
+def evict(db: sqlite3.Connection):
+	"""
+	Remove expired entries, then the least recently used ones until the cache fits the maximum size.
+	"""
+	max_age = config.LLM_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+	max_size = config.LLM_CACHE_MAX_SIZE_MB * 1024 * 1024
+
+	with db:
+		db.execute("DELETE FROM responses WHERE created_at < ?", (int(time.time()) - max_age,))
+
+		size = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+		if size <= max_size:
+			return
+
+		# Remove the least recently used entries until we're below the limit
+		to_remove = []
+		for key, entry_size in db.execute("SELECT key, size FROM responses ORDER BY last_used_at"):
+			if size <= max_size:
+				break
+			to_remove.append((key,))
+			size -= entry_size
+		db.executemany("DELETE FROM responses WHERE key = ?", to_remove)
+
+	print(f"Removed {len(to_remove)} responses from the LLM cache")
+
+
+def print_stats():
+	total = stats["hits"] + stats["misses"]
+	if total:
+		print(f"  LLM cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hits'] / total:.0%} hit rate)")
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Runs LLM prompts concurrently.
+
+Questions are sent in chunks to OpenAI with a bounded number of requests in flight,
+over one shared `AsyncOpenAI` client, while staying below the requests-per-minute
+and tokens-per-minute limits set in `config.py`. Results are returned in the
+same order as the questions, regardless of the order the responses come back in.
+"""
+import time
+import asyncio
+import openai
+
+from typing import Awaitable, Callable
+
+import config
+import llm_cache
+
+
+class TokenBucket:
+	"""
+	Async token bucket rate limiter.
+
+	Holds up to `capacity` tokens and refills `rate` tokens per second.
+	"""
+
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = asyncio.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	async def acquire(self, amount: float = 1):
+		"""
+		Wait until `amount` tokens are available and take them.
+		"""
+		# Requests larger than the bucket would wait forever
+		amount = min(amount, self.capacity)
+
+		async with self.lock:
+			self._refill()
+			while self.tokens < amount:
+				await asyncio.sleep((amount - self.tokens) / self.rate)
+				self._refill()
+			self.tokens -= amount
+
+	def refund(self, amount: float):
+		"""
+		Give back tokens that were reserved but not used.
+		"""
+		self._refill()
+		self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveChunkSize:
+	"""
+	Number of questions to send per prompt, adapted to how often the LLM leaves out items.
+
+	Grows by one after as many complete chunks in a row as the current size,
+	and halves when a chunk comes back with missing items.
+	"""
+
+	def __init__(self, size: int, min_size: int = 1, max_size: int = None):
+		self.size = size
+		self.min_size = min_size
+		self.max_size = max_size or size
+		self.successes = 0
+
+	def record(self, chunk_length: int, missing: int):
+		"""
+		Register the outcome of a chunk.
+		"""
+		if missing:
+			self.size = max(self.min_size, self.size // 2)
+			self.successes = 0
+			return
+
+		# Only count chunks that were as large as the current size
+		if chunk_length >= self.size:
+			self.successes += 1
+			if self.successes >= self.size and self.size < self.max_size:
+				self.size += 1
+				self.successes = 0
+
+
+def estimate_tokens(text: str) -> int:
+	"""
+	Rough estimation of the number of tokens in a text (about four characters per token).
+	"""
+	return len(text) // 4 + 1
+
+
+def next_chunk_end(items: list, start: int, item_tokens: Callable, max_items: int) -> int:
+	"""
+	Where the chunk starting at `start` should end, so that it holds at most `max_items` items
+	and fits the token budgets.
+
+	`item_tokens(item)` estimates the (input, output) tokens of an item. A chunk is filled
+	until its input reaches `CHUNK_INPUT_TOKENS` or its expected output would no longer
+	fit in `MAX_OUTPUT_TOKENS` (with some headroom). A chunk always holds at least one item.
+	"""
+	max_output_tokens = config.MAX_OUTPUT_TOKENS * 0.8
+	input_tokens = 0
+	output_tokens = 0
+
+	end = start
+	while end < len(items) and end - start < max_items:
+		item_input_tokens, item_output_tokens = item_tokens(items[end])
+		if end > start and (
+				input_tokens + item_input_tokens > config.CHUNK_INPUT_TOKENS or
+				output_tokens + item_output_tokens > max_output_tokens):
+			break
+		input_tokens += item_input_tokens
+		output_tokens += item_output_tokens
+		end += 1
+
+	return end
+
+
+def pack_items(items: list, item_tokens: Callable, max_items: int) -> list:
+	"""
+	Split items into chunks that fit the token budgets (see `next_chunk_end()`).
+	"""
+	chunks = []
+	start = 0
+	while start < len(items):
+		end = next_chunk_end(items, start, item_tokens, max_items)
+		chunks.append(items[start:end])
+		start = end
+
+	return chunks
+
+
+class TruncatedResponseError(Exception):
+	"""
+	Raised when the LLM stopped because it reached `MAX_OUTPUT_TOKENS`.
+	"""
+	pass
+
+
+class LLMExecutor:
+	"""
+	Sends prompts to OpenAI concurrently with one shared client.
+
+	Use as an async context manager so the client is closed afterwards:
+
+		async with LLMExecutor() as executor:
+			results = await executor.map_items(questions, run_chunk, item_tokens)
+	"""
+
+	def __init__(self, concurrency: int = None, rpm: int = None, tpm: int = None):
+		self.client = openai.AsyncOpenAI(api_key=config.OPENAI_KEY)
+		self.concurrency = concurrency or config.OPENAI_CONCURRENCY
+		# Bounds the requests in flight, also when several stages share the executor
+		self.slots = asyncio.Semaphore(self.concurrency)
+		self.chunk_size = AdaptiveChunkSize(config.CHUNKS, max_size=config.MAX_CHUNKS)
+
+		rpm = rpm or config.OPENAI_RPM
+		tpm = tpm or config.OPENAI_TPM
+		self.request_limiter = TokenBucket(rpm / 60, rpm)
+		self.token_limiter = TokenBucket(tpm / 60, tpm)
+
+		# API usage (excluding cache hits)
+		self.usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *args):
+		await self.close()
+
+	async def close(self):
+		await self.client.close()
+
+	async def get_answer(self, prompt: str, response_format="json_object", model=None, refresh=False) -> str:
+		"""
+		Async version of `helpers.get_openai_answer()` that respects the rate limits.
+
+		Answers are looked up in and added to the LLM cache. Use `refresh` to skip the
+		lookup, e.g. when retrying because a cached answer turned out to be invalid.
+		"""
+		if not model:
+			model = config.MODEL
+
+		cache_key = llm_cache.make_key(model, prompt, response_format)
+		if not refresh:
+			cached_answer = llm_cache.get(cache_key)
+			if cached_answer is not None:
+				return cached_answer
+
+		# OpenAI counts `max_tokens` towards the token limit, so reserve that
+		# and give back what wasn't used once we know the actual usage.
+		reserved_tokens = estimate_tokens(prompt) + config.MAX_OUTPUT_TOKENS
+		await self.request_limiter.acquire()
+		await self.token_limiter.acquire(reserved_tokens)
+
+		async with self.slots:
+			response = await self.client.chat.completions.create(
+				model=model,
+				temperature=config.TEMPERATURE,
+				max_tokens=config.MAX_OUTPUT_TOKENS,
+				response_format={"type": response_format},
+				messages=[{
+					"role": "user",
+					"content": prompt
+				}]
+			)
+
+		self.usage["requests"] += 1
+		if response.usage:
+			self.token_limiter.refund(max(reserved_tokens - response.usage.total_tokens, 0))
+			self.usage["prompt_tokens"] += response.usage.prompt_tokens
+			self.usage["completion_tokens"] += response.usage.completion_tokens
+
+		# Don't cache truncated answers; the caller should split the prompt up instead
+		if response.choices[0].finish_reason == "length":
+			raise TruncatedResponseError(f"LLM response reached the maximum of {config.MAX_OUTPUT_TOKENS} tokens")
+
+		answer = response.choices[0].message.content
+		llm_cache.put(cache_key, answer)
+
+		return answer
+
+	async def map_items(self, items: list, run_chunk: Callable[["LLMExecutor", list], Awaitable[list]], item_tokens: Callable, description="Processed", on_chunk: Callable = None) -> list:
+		"""
+		Split `items` into chunks and run `run_chunk(executor, chunk)` for each, with at most
+		`OPENAI_CONCURRENCY` chunks in flight. Chunks are cut as we go, so each uses the
+		current adaptive chunk size, and are packed to fit the token budgets (see `next_chunk_end()`).
+
+		`run_chunk` returns a result per item in the chunk (or None if it failed) and is
+		responsible for retrying, so a failing chunk doesn't hold up the others.
+		`on_chunk(chunk, chunk_results)` is called after each chunk, e.g. to save progress.
+		Returns the results in the order of `items`.
+		"""
+		results = [None] * len(items)
+		pos = 0
+		done = 0
+
+		async def worker():
+			nonlocal pos, done
+			while pos < len(items):
+				start = pos
+				pos = next_chunk_end(items, start, item_tokens, self.chunk_size.size)
+				chunk_results = await run_chunk(self, items[start:pos])
+				results[start:start + len(chunk_results)] = chunk_results
+				if on_chunk:
+					on_chunk(items[start:start + len(chunk_results)], chunk_results)
+
+				done += len(chunk_results)
+				print(f"  {description} {done}/{len(items)} questions")
+
+		await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+		return results
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Near-duplicate index for simplified questions, using MinHash and LSH banding.
+
+The LLM words the same question slightly differently now and then ("Why is X ..."
+vs "Why are X ..."), so grouping questions by an exact hash splits them over several
+records that each stay below `QUESTION_THRESHOLD`. Here, questions are compared on
+their content words: everything but articles and forms of "be", "do" and "have". So
+small wording changes don't count, but a different content word ("legal" vs "illegal",
+"Jews" vs "Christians") does. Word pairs are compared as well, so the word order counts.
+
+Every question gets a MinHash signature of these features. Signatures are split into
+bands, and only questions that share a band bucket are compared, on the exact
+similarity of their features. If it's at least `NEAR_DUPLICATE_THRESHOLD`, they're put
+in the same cluster. A cluster is identified by the hash of the first question in it,
+which is also the key of its merged record.
+
+The index is stored in the pipeline database next to the questions:
+- the cluster of every simplified question hash we've seen,
+- the text of the first question of every cluster,
+- the band buckets of the signatures of these texts.
+Looking up a question only touches its own buckets, so it doesn't slow down as the
+number of questions grows. See `benchmarks/near_duplicates.py` for choosing a threshold.
+"""
+import re
+import json
+import struct
+import hashlib
+
+import config
+import stores
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+
+# Hash functions of the form (a * x + b) mod p, derived from fixed seeds so signatures stay the same across runs
+MERSENNE_PRIME = (1 << 61) - 1
+PERMUTATIONS = [
+	(
+		int.from_bytes(hashlib.blake2b(f"a{i}".encode("utf-8"), digest_size=8).digest(), "little") % (MERSENNE_PRIME - 1) + 1,
+		int.from_bytes(hashlib.blake2b(f"b{i}".encode("utf-8"), digest_size=8).digest(), "little") % MERSENNE_PRIME
+	) for i in range(NUM_PERMUTATIONS)
+]
+
+# Words that the LLM changes without changing the question, including what's left
+# of them in contractions ("what's", "they're"). Negations and question words
+# ("why", "how") are content words.
+STOPWORDS = frozenset((
+	"a", "an", "the",
+	"am", "is", "are", "was", "were", "be", "been", "being", "m", "s", "re",
+	"do", "does", "did", "has", "have", "had", "ve"
+))
+
+_tables_created = False
+
+
+def get_db():
+	"""
+	Get the pipeline database, with the tables of the index.
+	"""
+	global _tables_created
+
+	db = stores.get_db()
+	if not _tables_created:
+		with db:
+			db.execute("""
+				CREATE TABLE IF NOT EXISTS near_duplicate_questions (
+					hash TEXT PRIMARY KEY,
+					cluster TEXT NOT NULL
+				) WITHOUT ROWID
+			""")
+			db.execute("""
+				CREATE TABLE IF NOT EXISTS near_duplicate_clusters (
+					cluster TEXT PRIMARY KEY,
+					text TEXT NOT NULL
+				) WITHOUT ROWID
+			""")
+			db.execute("""
+				CREATE TABLE IF NOT EXISTS near_duplicate_bands (
+					bucket INTEGER NOT NULL,
+					cluster TEXT NOT NULL,
+					PRIMARY KEY (bucket, cluster)
+				) WITHOUT ROWID
+			""")
+		_tables_created = True
+		index_existing_questions(db)
+
+	return db
+
+
+def get_words(text: str) -> list:
+	"""
+	The content words of a question, in order (lowercase, only letters and numbers, like `helpers.clean_and_hash()`).
+	"""
+	text = re.sub(r"n't\b", " not", text.lower().replace("’", "'"))
+	return [word for word in re.sub(r"[^0-9a-zà-ÿ]+", " ", text).split() if word not in STOPWORDS]
+
+
+def get_features(text: str) -> set:
+	"""
+	The content words of a question and the pairs of consecutive content words.
+	"""
+	words = get_words(text)
+	return set(words) | set(" ".join(pair) for pair in zip(words, words[1:]))
+
+
+def get_similarity(text: str, other_text: str) -> float:
+	"""
+	Jaccard similarity of the features of two questions.
+	"""
+	features = get_features(text)
+	other_features = get_features(other_text)
+	if not features or not other_features:
+		return 0.0
+
+	return len(features & other_features) / len(features | other_features)
+
+
+def get_signature(features: set) -> tuple:
+	"""
+	MinHash signature of a set of features.
+	"""
+	feature_hashes = [int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little") for feature in features]
+	if not feature_hashes:
+		return (MERSENNE_PRIME,) * NUM_PERMUTATIONS
+
+	return tuple(min((a * feature_hash + b) % MERSENNE_PRIME for feature_hash in feature_hashes) for a, b in PERMUTATIONS)
+
+
+def get_buckets(signature: tuple) -> list:
+	"""
+	One bucket per band of the signature. Buckets include the band number, so bands don't collide.
+	"""
+	buckets = []
+	for band in range(BANDS):
+		band_values = struct.pack(f"<I{ROWS_PER_BAND}Q", band, *signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+		buckets.append(int.from_bytes(hashlib.blake2b(band_values, digest_size=8).digest(), "little", signed=True))
+
+	return buckets
+
+
+def add_cluster(db, cluster: str, text: str, buckets: list):
+	db.execute("INSERT OR IGNORE INTO near_duplicate_clusters (cluster, text) VALUES (?, ?)", (cluster, text))
+	db.executemany("INSERT OR IGNORE INTO near_duplicate_bands (bucket, cluster) VALUES (?, ?)", ((bucket, cluster) for bucket in buckets))
+
+
+def get_cluster(question_hash: str, text: str) -> str:
+	"""
+	Get the cluster of a simplified question, adding the question to the index.
+
+	Returns the hash of the first question of the most similar cluster, if it's at least
+	`NEAR_DUPLICATE_THRESHOLD` similar, or `question_hash` itself if there's none (making it a new cluster).
+	Changes aren't committed, so they can be part of the merge transaction.
+	"""
+	if not config.NEAR_DUPLICATE_THRESHOLD:
+		return question_hash
+
+	db = get_db()
+	row = db.execute("SELECT cluster FROM near_duplicate_questions WHERE hash = ?", (question_hash,)).fetchone()
+	if row:
+		return row[0]
+
+	buckets = get_buckets(get_signature(get_features(text)))
+
+	# MinHash only finds the candidates; they're compared on their exact similarity
+	placeholders = ",".join("?" * len(buckets))
+	candidates = db.execute(f"""
+		SELECT DISTINCT near_duplicate_clusters.cluster, text FROM near_duplicate_bands
+		JOIN near_duplicate_clusters ON near_duplicate_clusters.cluster = near_duplicate_bands.cluster
+		WHERE bucket IN ({placeholders})
+	""", buckets).fetchall()
+
+	cluster = question_hash
+	best_similarity = config.NEAR_DUPLICATE_THRESHOLD
+	for candidate, candidate_text in candidates:
+		similarity = get_similarity(text, candidate_text)
+		if similarity >= best_similarity:
+			cluster = candidate
+			best_similarity = similarity
+
+	if cluster == question_hash:
+		add_cluster(db, cluster, text, buckets)
+	db.execute("INSERT OR IGNORE INTO near_duplicate_questions (hash, cluster) VALUES (?, ?)", (question_hash, cluster))
+
+	return cluster
+
+
+def index_existing_questions(db):
+	"""
+	Add the questions that were merged before the index existed, each as its own cluster.
+	"""
+	indexed = db.execute("SELECT 1 FROM near_duplicate_questions LIMIT 1").fetchone()
+	if indexed or not config.NEAR_DUPLICATE_THRESHOLD:
+		return
+
+	count = 0
+	with db:
+		for question_hash, data in db.execute("SELECT hash, data FROM questions"):
+			text = json.loads(data)["question_simplified_contextualized"]
+			add_cluster(db, question_hash, text, get_buckets(get_signature(get_features(text))))
+			db.execute("INSERT OR IGNORE INTO near_duplicate_questions (hash, cluster) VALUES (?, ?)", (question_hash, question_hash))
+			count += 1
+
+	if count:
+		print(f"Added {count} existing questions to the near-duplicate index")
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Offline bulk processing through the OpenAI Batch API.
+
+For backfills of many catalogs, requests are written to JSONL batch files,
+submitted, and polled until the batch is done. Results are returned by the
+`custom_id` of each request, so they can be merged back into the questions.
+Batches are cheaper than interactive requests and don't count towards the
+regular rate limits.
+
+Submitting and polling goes through a `BatchBackend`, so a local fake can be
+used instead of OpenAI (see `tests/test_openai_batch.py`).
+
+Custom IDs should be derived from the content of a request. Submitted batches
+are saved in the pipeline database with their custom IDs until their results
+are retrieved. If a run is interrupted while waiting for a batch, the next run
+waits for the same batch instead of submitting (and paying for) the requests in
+it again, and only submits the requests that weren't in it.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import openai
+
+from abc import ABC, abstractmethod
+
+import config
+import stores
+
+from helpers import pack_by_size
+
+
+class BatchBackend(ABC):
+	"""
+	Interface for submitting batch files and retrieving their results.
+	"""
+
+	@abstractmethod
+	def submit(self, batch_file: str, endpoint: str) -> str:
+		"""
+		Submit a JSONL batch file. Returns the ID of the batch.
+		"""
+
+	@abstractmethod
+	def poll(self, batch_id: str) -> str:
+		"""
+		Get the status of a batch, e.g. "in_progress", "completed", or "failed".
+		"""
+
+	@abstractmethod
+	def get_results(self, batch_id: str) -> list:
+		"""
+		Get the result lines of a completed batch, each a dict with a `custom_id` and a `response`.
+		"""
+
+
+class OpenAIBatchBackend(BatchBackend):
+	"""
+	Runs batches on OpenAI's Batch API.
+	"""
+
+	def __init__(self):
+		self.client = openai.OpenAI(api_key=config.OPENAI_KEY)
+
+	def submit(self, batch_file: str, endpoint: str) -> str:
+		with open(batch_file, "rb") as in_file:
+			uploaded_file = self.client.files.create(file=in_file, purpose="batch")
+
+		batch = self.client.batches.create(
+			input_file_id=uploaded_file.id,
+			endpoint=endpoint,
+			completion_window="24h"
+		)
+		return batch.id
+
+	def poll(self, batch_id: str) -> str:
+		return self.client.batches.retrieve(batch_id).status
+
+	def get_results(self, batch_id: str) -> list:
+		batch = self.client.batches.retrieve(batch_id)
+		if not batch.output_file_id:
+			return []
+
+		content = self.client.files.content(batch.output_file_id).text
+		return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+# Statuses after which a batch won't change anymore
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+_backend = None
+
+
+def get_backend() -> BatchBackend:
+	global _backend
+	if _backend is None:
+		_backend = OpenAIBatchBackend()
+	return _backend
+
+
+def set_backend(backend: BatchBackend):
+	"""
+	Use a different backend, e.g. a local fake for testing.
+	"""
+	global _backend
+	_backend = backend
+
+
+def get_batch_line(custom_id: str, body: dict, endpoint: str) -> str:
+	"""
+	A request as a line of a JSONL batch file.
+	"""
+	return json.dumps({
+		"custom_id": custom_id,
+		"method": "POST",
+		"url": endpoint,
+		"body": body
+	}) + "\n"
+
+
+def write_batch_file(batch_file: str, lines: list):
+	"""
+	Write request lines (see `get_batch_line()`) to a JSONL batch file.
+	"""
+	with open(batch_file, "w", encoding="utf-8") as out_jsonl:
+		out_jsonl.writelines(lines)
+
+
+def get_custom_id(name: str, body) -> str:
+	"""
+	Custom ID of a request, derived from its content so it's the same in a re-run.
+	"""
+	return f"{name}-{hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()}"
+
+
+async def run_batch(requests: dict, endpoint: str, name: str) -> dict:
+	"""
+	Run requests as one or more batches and wait until they're done.
+
+	`requests` maps custom IDs to request bodies. Returns the response bodies of
+	successful requests, keyed by custom ID. Failed requests are left out.
+	Requests that are in a batch submitted earlier under the same `name` (by an
+	interrupted run) aren't submitted again; we wait for that batch instead.
+	"""
+	backend = get_backend()
+	os.makedirs(config.BATCH_DIR, exist_ok=True)
+
+	batch_ids = []
+	custom_ids = list(requests.keys())
+	for batch_id, batch_custom_ids in stores.get_batches(name).items():
+		if requests.keys() & set(batch_custom_ids):
+			print(f"  Resuming batch {batch_id} for {name}")
+			batch_ids.append(batch_id)
+			custom_ids = [custom_id for custom_id in custom_ids if custom_id not in set(batch_custom_ids)]
+		else:
+			# None of its results are needed anymore, e.g. because they were retrieved interactively
+			stores.delete_batch(batch_id)
+
+	# OpenAI limits both the number of requests and the size of a batch file
+	lines = [get_batch_line(custom_id, requests[custom_id], endpoint) for custom_id in custom_ids]
+	for n, batch in enumerate(pack_by_size(lines, config.BATCH_MAX_REQUESTS, config.BATCH_MAX_BYTES, size=lambda line: len(line.encode("utf-8")))):
+		batch_custom_ids = [custom_ids[i] for i in batch]
+		batch_file = os.path.join(config.BATCH_DIR, f"{name}_{int(time.time())}_{n}.jsonl")
+		write_batch_file(batch_file, [lines[i] for i in batch])
+		batch_id = await asyncio.to_thread(backend.submit, batch_file, endpoint)
+		stores.add_batch(batch_id, name, batch_custom_ids)
+		print(f"  Submitted {batch_file} as batch {batch_id}")
+		batch_ids.append(batch_id)
+
+	responses = {}
+	for batch_id in batch_ids:
+		status = await asyncio.to_thread(backend.poll, batch_id)
+		while status not in FINAL_STATUSES:
+			await asyncio.sleep(config.BATCH_POLL_INTERVAL)
+			status = await asyncio.to_thread(backend.poll, batch_id)
+
+		if status != "completed":
+			print(f"  Batch {batch_id} ended with status '{status}'")
+
+		for result in await asyncio.to_thread(backend.get_results, batch_id):
+			response = result.get("response")
+			if result.get("custom_id") in requests and response and response.get("status_code") == 200:
+				responses[result["custom_id"]] = response["body"]
+
+		# The caller saves the results; failed requests are sent again next time
+		stores.delete_batch(batch_id)
+
+	print(f"  {len(responses)}/{len(requests)} batch requests for {name} succeeded")
+	return responses
+
+
+def chat_completion_body(prompt: str, response_format="json_object", model=None) -> dict:
+	"""
+	Request body for the chat completions endpoint, with the same settings as `helpers.get_openai_answer()`.
+	"""
+	return {
+		"model": model or config.MODEL,
+		"temperature": config.TEMPERATURE,
+		"max_tokens": config.MAX_OUTPUT_TOKENS,
+		"response_format": {"type": response_format},
+		"messages": [{
+			"role": "user",
+			"content": prompt
+		}]
+	}
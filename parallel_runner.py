@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Processes many catalog snapshots in parallel.
+
+`chan_questions.process()` handles one snapshot at a time, so the CPU-bound work
+(rebuilding snapshots, cleaning HTML, extracting questions) and the API stages
+never overlap. Here, snapshots are extracted on a process pool with one board
+per task, so a worker can replay the deltas of a board in order. As soon as a
+board is extracted, its new questions are sent to the API stages on one shared
+`LLMExecutor` while other boards are still being extracted. Questions that are
+already being sent for another board aren't sent twice.
+
+Results are merged into the question store in one place: the main process,
+one catalog at a time and in chronological order per board.
+
+With `BATCH_MODE`, every board is extracted first, and the API stages run once
+for the new questions of all of them, so a backfill is one OpenAI batch per
+stage instead of one per snapshot or board.
+"""
+import os
+import asyncio
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import stores
+import llm_cache
+import catalog_store
+import chan_questions
+
+from llm_executor import LLMExecutor
+
+
+def extract_board(catalog_files: list) -> list:
+	"""
+	Extract the questions of the snapshots of one board, in order. Runs in a worker process.
+
+	OPs aren't marked as processed until their snapshot is merged, so OPs
+	of earlier snapshots in this run are skipped here. Snapshots that were
+	extracted in an interrupted run are loaded from their checkpoint.
+	"""
+	extracted_catalogs = []
+	seen_op_ids = set()
+	for catalog_file in catalog_files:
+		extracted = stores.get_extracted_catalog(catalog_file) or chan_questions.extract_catalog(catalog_file, seen_op_ids)
+		seen_op_ids.update(extracted["new_op_ids"])
+		extracted_catalogs.append(extracted)
+
+	return extracted_catalogs
+
+
+class ParallelRunner:
+	"""
+	Runs the API stages for the boards of one run, with a shared executor, and merges the results.
+	"""
+
+	def __init__(self, executor: LLMExecutor):
+		self.executor = executor
+		self.toxicity_lock = asyncio.Lock()
+
+		# API results of this run, and the results that are still being retrieved,
+		# by the hash of the original question
+		self.results = {}
+		self.pending = {}
+
+	async def get_results(self, questions: list) -> tuple:
+		"""
+		Get the API results for questions, only sending the ones that weren't seen before.
+		Returns the results for these questions, and the results that are new in this call.
+		"""
+		hashes = set(q["question_hash_original"] for q in questions)
+		self.results.update(chan_questions.get_known_results(hashes - self.results.keys() - self.pending.keys()))
+
+		new_questions = chan_questions.get_new_questions(questions, self.results.keys() | self.pending.keys())
+		print(f"  {len(questions) - len(new_questions)} questions are duplicates or were seen before, {len(new_questions)} are new")
+
+		done = asyncio.get_running_loop().create_future()
+		for question in new_questions:
+			self.pending[question["question_hash_original"]] = done
+
+		try:
+			new_questions = await chan_questions.run_api_stages(new_questions, self.executor, self.toxicity_lock)
+		except Exception as e:
+			done.set_exception(e)
+			raise
+
+		new_results = chan_questions.get_question_results(new_questions)
+		self.results.update(new_results)
+		for question_hash in list(self.pending):
+			if self.pending[question_hash] is done:
+				del self.pending[question_hash]
+		done.set_result(True)
+
+		# Wait for the questions that are being sent for other boards
+		await asyncio.gather(*set(self.pending[h] for h in hashes if h in self.pending))
+
+		return {h: self.results[h] for h in hashes if h in self.results}, new_results
+
+	async def extract_board(self, pool: ProcessPoolExecutor, catalog_files: list) -> list:
+		"""
+		Extract the snapshots of a board on the pool, and save them so an interrupted run can resume.
+		"""
+		extracted_catalogs = await asyncio.get_running_loop().run_in_executor(pool, extract_board, catalog_files)
+		stores.save_extracted_catalogs([extracted for extracted in extracted_catalogs if extracted["questions"]])
+		return extracted_catalogs
+
+	def merge_board(self, extracted_catalogs: list, results: dict, new_results: dict) -> dict:
+		"""
+		Merge the results into the snapshots of a board, in order, and mark them as processed.
+		Returns the new results that weren't stored yet.
+		"""
+		for extracted in extracted_catalogs:
+			if not extracted["questions"]:
+				stores.add_processed_op_ids(extracted["board"], extracted["new_op_ids"])
+				outputs = []
+			else:
+				outputs = chan_questions.merge_catalog(extracted, results, new_results)
+
+				# New results only need to be stored once
+				if outputs:
+					new_results = {}
+
+			stores.set_catalog_processed(extracted["catalog_file"], outputs)
+
+		return new_results
+
+	async def process_board(self, pool: ProcessPoolExecutor, catalog_files: list):
+		"""
+		Extract the snapshots of a board on the pool, run the API stages, and merge the results.
+		"""
+		extracted_catalogs = await self.extract_board(pool, catalog_files)
+
+		questions = [q for extracted in extracted_catalogs for q in extracted["questions"]]
+		results, new_results = {}, {}
+		if questions:
+			print(f"Processing {len(questions)} questions from {len(catalog_files)} {extracted_catalogs[0]['board']} catalogs")
+			results, new_results = await self.get_results(questions)
+
+		self.merge_board(extracted_catalogs, results, new_results)
+
+	async def process_boards_as_batch(self, pool: ProcessPoolExecutor, boards: list):
+		"""
+		Extract all boards, run the API stages once for all their questions, and merge the results.
+		"""
+		boards_extracted = await asyncio.gather(*[self.extract_board(pool, catalog_files) for catalog_files in boards])
+
+		questions = [q for extracted_catalogs in boards_extracted for extracted in extracted_catalogs for q in extracted["questions"]]
+		results, new_results = {}, {}
+		if questions:
+			print(f"Processing {len(questions)} questions from {sum(len(catalog_files) for catalog_files in boards)} catalogs as one batch")
+			results, new_results = await self.get_results(questions)
+
+		for extracted_catalogs in boards_extracted:
+			new_results = self.merge_board(extracted_catalogs, results, new_results)
+
+
+async def run_boards(boards: list, workers: int):
+	# Spawn fresh workers, so they don't share the database connections of this process
+	with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+		async with LLMExecutor() as executor:
+			runner = ParallelRunner(executor)
+			if config.BATCH_MODE:
+				await runner.process_boards_as_batch(pool, boards)
+			else:
+				await asyncio.gather(*[runner.process_board(pool, catalog_files) for catalog_files in boards])
+
+	llm_cache.print_stats()
+
+
+def run(catalog_files: list, workers: int = None):
+	"""
+	Process catalog snapshots with `workers` processes (`PROCESS_WORKERS` by default),
+	and mark them as processed.
+	"""
+	boards = {}
+	for catalog_file in catalog_files:
+		boards.setdefault(os.path.dirname(catalog_file), []).append(catalog_file)
+	boards = [sorted(catalog_files, key=catalog_store.snapshot_timestamp) for catalog_files in boards.values()]
+
+	asyncio.run(run_boards(boards, workers or config.PROCESS_WORKERS))
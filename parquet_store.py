@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet export of the merged questions, partitioned by board and month.
+
+`stores.export_questions()` rewrites one JSON and one CSV file with every
+question, with all columns as text. Here, questions are written as Parquet with
+typed columns (integers for counts and timestamps, floats for the scores, a
+bool for `explicit`, and lists for the occurrence history), to:
+- `data/questions.parquet/board=<board>/month=<YYYY-MM>/questions.parquet`
+
+A question is put in the partition of the board and month it was first seen in,
+so it stays in the same file as it's seen again. Exports are incremental: only
+the partitions with questions that are new or were seen again since the last
+export are rewritten.
+
+`read_questions()` reads the export lazily, loading only the given columns and
+skipping partitions and row groups that don't match the filters.
+"""
+import os
+import json
+import time
+import datetime
+import urllib.parse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import config
+import stores
+
+PARTITION_FILE = "questions.parquet"
+PARTITIONING = ds.partitioning(pa.schema([("board", pa.string()), ("month", pa.string())]), flavor="hive")
+
+# Columns that aren't scores, by type. Any other numeric column (Perspective and
+# OpenAI moderation scores) is stored as a float.
+STRING_COLUMNS = ("hash", "question_simplified_contextualized", "url_google", "url_bing", "subject")
+INTEGER_COLUMNS = ("count", "replies", "first_seen", "last_seen")
+COLUMN_TYPES = {
+	"explicit": pa.bool_(),
+	"subject_counts": pa.map_(pa.string(), pa.int64()),
+	"explicit_counts": pa.map_(pa.string(), pa.int64()),
+	"boards": pa.list_(pa.string()),
+	"ids": pa.list_(pa.int64()),
+	"timestamps": pa.list_(pa.int64()),
+	"questions_original": pa.list_(pa.string()),
+	"subjects_all": pa.list_(pa.string()),
+	"explicit_all": pa.list_(pa.bool_()),
+	**{column: pa.string() for column in STRING_COLUMNS},
+	**{column: pa.int64() for column in INTEGER_COLUMNS}
+}
+
+_table_created = False
+
+
+def get_db():
+	"""
+	Get the pipeline database, with the table that keeps track of what's exported.
+	"""
+	global _table_created
+
+	db = stores.get_db()
+	if not _table_created:
+		with db:
+			db.execute("""
+				CREATE TABLE IF NOT EXISTS exported_questions (
+					hash TEXT PRIMARY KEY,
+					count INTEGER NOT NULL,
+					partition TEXT NOT NULL
+				) WITHOUT ROWID
+			""")
+			db.execute("CREATE INDEX IF NOT EXISTS exported_questions_partition ON exported_questions (partition)")
+		_table_created = True
+
+	return db
+
+
+def get_column_type(column: str, value) -> pa.DataType:
+	if column in COLUMN_TYPES:
+		return COLUMN_TYPES[column]
+	if column.endswith("_count"):
+		return pa.int64()
+	if isinstance(value, (int, float, type(None))) and not isinstance(value, bool) or value == "":
+		return pa.float64()
+	return pa.string()
+
+
+def get_column_value(column_type: pa.DataType, value):
+	"""
+	Convert a value of a question record to the type of its column.
+	Scores that are missing or empty (e.g. after a failed Perspective call) become null.
+	"""
+	if pa.types.is_floating(column_type):
+		return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+	if pa.types.is_map(column_type):
+		return list(value.items()) if value is not None else None
+	if pa.types.is_string(column_type) and value is not None and not isinstance(value, str):
+		return json.dumps(value)
+	return value
+
+
+def get_partition(question: dict, history: dict) -> str:
+	"""
+	The partition of a question: the board and month it was first seen in, e.g. `board=leftypol/month=2024-11`.
+	Occurrences from before boards were stored have no board; those questions go to the board they were seen most on.
+	"""
+	board = history["boards"][0] if history["boards"] else ""
+	if not board:
+		board_counts = {k[:-len("_count")]: v for k, v in question.items() if k.endswith("_count")}
+		board = max(board_counts, key=board_counts.get) if board_counts else "unknown"
+
+	first_seen = question.get("first_seen")
+	month = datetime.datetime.fromtimestamp(first_seen, datetime.timezone.utc).strftime("%Y-%m") if first_seen is not None else "unknown"
+
+	return f"board={urllib.parse.quote(board, safe='')}/month={month}"
+
+
+def questions_to_table(questions: dict, histories: dict) -> pa.Table:
+	"""
+	Convert question records and their occurrence history to a table with typed columns.
+	"""
+	rows = [{**question, **histories[question_hash]} for question_hash, question in questions.items()]
+
+	schema = {}
+	for row in rows:
+		for column, value in row.items():
+			if column not in schema or (value is not None and value != ""):
+				schema[column] = get_column_type(column, value)
+	schema = pa.schema(sorted(schema.items(), key=lambda column: (column[0] not in COLUMN_TYPES, column[0])))
+
+	columns = {
+		column.name: pa.array([get_column_value(column.type, row.get(column.name)) for row in rows], type=column.type)
+		for column in schema
+	}
+	return pa.table(columns, schema=schema)
+
+
+def write_partition(partition: str, question_hashes: list) -> dict:
+	"""
+	(Re)write the Parquet file of a partition with the given questions. Returns the exported question records.
+	"""
+	questions = stores.get_questions(question_hashes)
+	table = questions_to_table(questions, stores.get_question_histories(questions.keys()))
+
+	partition_dir = os.path.join(config.PARQUET_DIR, partition)
+	os.makedirs(partition_dir, exist_ok=True)
+
+	# Write next to the old file first, so readers never see a half-written partition.
+	# Files starting with a dot are skipped by readers.
+	partition_file = os.path.join(partition_dir, PARTITION_FILE)
+	temporary_file = os.path.join(partition_dir, "." + PARTITION_FILE + ".tmp")
+	pq.write_table(table.sort_by("hash"), temporary_file, compression="zstd")
+	os.replace(temporary_file, partition_file)
+
+	return questions
+
+
+def export_questions():
+	"""
+	Export the questions that are new or were seen again since the last export, by
+	rewriting the partitions they're in.
+	"""
+	start_time = time.time()
+	db = get_db()
+
+	changed = db.execute("""
+		SELECT question_index.hash, exported_questions.partition FROM question_index
+		LEFT JOIN exported_questions ON exported_questions.hash = question_index.hash
+		WHERE exported_questions.count IS NULL OR exported_questions.count != question_index.count
+	""").fetchall()
+
+	if not changed:
+		print("No new questions to export")
+		return
+
+	# Questions that weren't exported before get a partition based on their first occurrence
+	partitions = {}
+	new_hashes = [question_hash for question_hash, partition in changed if partition is None]
+	for pos in range(0, len(new_hashes), 500):
+		hashes_chunk = new_hashes[pos:pos + 500]
+		questions = stores.get_questions(hashes_chunk)
+		histories = stores.get_question_histories(questions.keys())
+		for question_hash, question in questions.items():
+			partitions.setdefault(get_partition(question, histories[question_hash]), []).append(question_hash)
+
+	for partition in set(partition for question_hash, partition in changed if partition is not None):
+		partitions.setdefault(partition, [])
+
+	# Rewrite every changed partition, with the questions that were already in it
+	exported = 0
+	for partition, question_hashes in partitions.items():
+		question_hashes += [row[0] for row in db.execute("SELECT hash FROM exported_questions WHERE partition = ?", (partition,))]
+		questions = write_partition(partition, question_hashes)
+
+		with db:
+			db.executemany(
+				"INSERT OR REPLACE INTO exported_questions (hash, count, partition) VALUES (?, ?, ?)",
+				((question_hash, question["count"], partition) for question_hash, question in questions.items())
+			)
+		exported += len(questions)
+
+	print(f"Exported {len(changed)} new or updated questions to {len(partitions)} partitions ({exported} questions) "
+		  f"of {config.PARQUET_DIR} in {time.time() - start_time:.1f}s")
+
+
+def get_dataset() -> ds.Dataset:
+	"""
+	Open the Parquet export as a (lazy) dataset, with `board` and `month` as columns.
+	Partitions can have different score columns, so they're combined into one schema.
+	"""
+	dataset = ds.dataset(config.PARQUET_DIR, format="parquet", partitioning=PARTITIONING)
+	schema = pa.unify_schemas([pq.read_schema(fragment.path) for fragment in dataset.get_fragments()] + [PARTITIONING.schema])
+
+	return ds.dataset(config.PARQUET_DIR, format="parquet", partitioning=PARTITIONING, schema=schema)
+
+
+def read_questions(columns: list = None, filters=None) -> pd.DataFrame:
+	"""
+	Read exported questions into a DataFrame, e.g.:
+
+	`read_questions(["question_simplified_contextualized", "TOXICITY"], [("board", "=", "leftypol"), ("TOXICITY", ">=", 0.2)])`
+
+	Only the given columns are read. `filters` are (column, operator, value) tuples
+	(or a `pyarrow.dataset` expression); partitions that don't match the `board` and
+	`month` filters aren't opened, and row groups are skipped based on their statistics.
+	"""
+	if isinstance(filters, list):
+		filters = pq.filters_to_expression(filters)
+
+	return get_dataset().to_table(columns=columns, filter=filters).to_pandas()
@@ -29,16 +29,76 @@ The resulting question should be suitable for use in a search engine like Google
 **Input Format:**
 A JSON array of questions, each with:
 
+* `"id"`: A number identifying the question.
 * `"question"`: The original question extracted from the 4chan post.
 * `"full_text"`: The full text of the 4chan post containing the question.
 
 **Output Format:**
 A JSON array called "results" with the following structure for each question:
 
+* `"id"`: The `"id"` of the input question, unchanged.
 * `"question_simplified_contextualized"`: The simplified and contextualized question.
 
 **Important:** If a question cannot be simplified or contextualized, return the original question in `"question_simplified_contextualized"`.
-Make sure to output the same number of values as input values.
+Make sure to output one result for every input question, with the same `"id"`.
+
+Input:
+'[input]'
+
+"""
+
+SIMPLIFY_CONTEXTUALISE_AND_CATEGORISE = """
+You are an expert in grammar, internet culture, and online discussions, specializing in making questions from online forums like 4chan clear and searchable.
+
+Your task is to analyze a list of questions extracted from 4chan posts and perform the following for each question:
+
+1. **Simplify:** Condense the question to be more concise and explicit.
+Slang and Internet jargon (like 'normie') should be retained, but irrelevant words should be removed.
+Expand all contractions, like "isn't" to "is not".
+The resulting question should be suitable for use in a search engine like Google.
+
+* **Example:**
+	* **Original:** "So /pol/, how'd you really think Kamala Harris became black?"
+	* **Simplified:** "How did Kamala Harris become black?"
+
+2. **Contextualize:** Resolve any implicit references and pronouns by referring to the provided "full_text", which includes the surrounding post content. If you are unsure, retain the original text.
+
+* **Example:**
+	* **Question:** "Do you think they are black?"
+	* **Full Text:** "Let's talk about Indians. Do you think they're black?"
+	* **Simplified:** "Do you think Indians are black?"
+
+3. **Extract a subject:** The main subject of the simplified question in one to three words, e.g. "kamala harris" or "qanon".
+
+4. **Categorize:** Determine whether the *simplified* question is explicit or implicit.
+
+* **Explicit Question:** A question with a clearly stated subject that can be understood without additional context. These may contain Internet slang but are typically suitable for web searches.
+	Examples: "What is Kamala Harris' race?", "What is the cheapest shotgun I can get?"
+* **Implicit Question:** A question that relies on context or implied information to be understood. Search engines would likely struggle to understand the intent or context.
+	Examples: "Do you agree?", "What do you think about Ukraine?", "What is a better form of protest?"
+
+If you're unsure or cannot categorise the question, label the question as explicit.
+
+**Input Format:**
+A JSON array of questions, each with:
+
+* `"id"`: A number identifying the question.
+* `"question"`: The original question extracted from the 4chan post.
+* `"full_text"`: The full text of the 4chan post containing the question.
+
+**Output Format:**
+A JSON array called "results" with the following structure for each question:
+
+* `"id"`: The `"id"` of the input question, unchanged.
+* `"question_simplified_contextualized"`: The simplified and contextualized question.
+* `"subject"`: The subject of the question.
+* `"explicit"`: `true` if the simplified question is explicit, `false` otherwise.
+
+**Example Output:**
+{"results": [{ "id": 1, "question_simplified_contextualized": "How did Kamala Harris become black?", "subject": "kamala harris", "explicit": true }]}
+
+**Important:** If a question cannot be simplified or contextualized, return the original question in `"question_simplified_contextualized"`.
+Make sure to output one result for every input question, with the same `"id"`.
 
 Input:
 '[input]'
@@ -92,18 +152,22 @@ Search engines would likely struggle to understand the intent or context.
 **Instructions:**
 Analyze each question from the provided list and determine if it is explicit or implicit.
 If you're unsure or cannot categorise the question, label the question as explicit.
-Make sure to output the EXACT number of output values as input values. THIS IS VERY IMPORTANT.
+Make sure to output one result for every input question, with the same `"id"`. THIS IS VERY IMPORTANT.
 
 **Input Format:**
-A newline-separated list of questions.
+A JSON array of questions, each with:
+
+* `"id"`: A number identifying the question.
+* `"question"`: The question to categorise.
 
 **Output Format:**
-A JSON array with the value:
+A JSON array called "results" with the following structure for each question:
 
+* `"id"`: The `"id"` of the input question, unchanged.
 * `"explicit"`:  `true` if the question is explicit, `false` otherwise.
 
 **Example Output:**
-{"results": [{ "question": "What is the capital of France?", "explicit": true }, { "question": "Is it true?", "explicit": false } ]}
+{"results": [{ "id": 1, "explicit": true }, { "id": 2, "explicit": false } ]}
 
 Input:
 '[input]'
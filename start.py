@@ -13,13 +13,14 @@ INSERT YOUR SETTINGS AT CONFIG.PY (see config-example.py for an example)
 
 import chan_catalogs
 import chan_questions
-import json
-import glob
 
 import config
+import parallel_runner
+import parquet_store
 import serp_screenshots
+import stores
 
-from helpers import make_dirs, questions_above_thresholds
+from helpers import make_dirs
 
 
 if __name__ == '__main__':
@@ -33,28 +34,42 @@ if __name__ == '__main__':
 
 	if config.PROCESS_QUESTIONS:
 		# Extract questions for all catalog files that haven't been processed yet
-		unprocessed_catalog_files = []
-		processed_files = glob.glob("data/catalogs/**/*.json")
-		for f in processed_files:
-			file_name = f.split(".")[-2] + ".csv"
-			if file_name not in processed_files and "questions" not in file_name:
-				unprocessed_catalog_files.append(f)
+		unprocessed_catalog_files = stores.get_unprocessed_catalogs()
 
 		# Get questions from OPs and manipulate them with LLMs
-		for unprocessed_catalog_file in unprocessed_catalog_files:
-			chan_questions.process(unprocessed_catalog_file)
+		try:
+			if config.PROCESS_WORKERS > 1 or config.BATCH_MODE:
+				# Extract boards on a process pool while the API stages of other boards run.
+				# In batch mode, the questions of all catalogs go into one batch per stage.
+				parallel_runner.run(unprocessed_catalog_files)
+			else:
+				for unprocessed_catalog_file in unprocessed_catalog_files:
+					outputs = chan_questions.process(unprocessed_catalog_file)
+					stores.set_catalog_processed(unprocessed_catalog_file, outputs)
+		except chan_questions.ToxicityScoringError as e:
+			# Catalogs that weren't merged stay unprocessed, and resume from their saved results next time
+			print(f"Stopped processing catalogs: {e}")
 
 	if config.TAKE_SCREENSHOTS:
-		# Retrieve extracted questions
-		with open("data/questions.json", "r") as in_json:
-			questions = json.load(in_json)
-
-		# Only keep those above set threshold in config
-		questions = questions_above_thresholds(questions)
+		# Retrieve the extracted questions above the thresholds set in config
+		print("Filtering questions for those above the set thresholds")
+		print(f"  {stores.count_questions()} questions before filtering")
+		questions = stores.get_questions_above_thresholds(
+			config.QUESTION_THRESHOLD, config.MIN_TOXICITY, config.MUST_BE_EXPLICIT, new_since_capture=config.SCREENSHOT_NEW_ONLY)
+		print(f"  {len(questions)} questions after filtering")
 
 		if questions:
 			# Generate screenshots via 4CAT
 			for search_engine in config.SEARCH_ENGINES:
 				serp_screenshots.queue_screenshots_via_4cat(questions, search_engine=search_engine)
+			stores.set_questions_captured(questions)
+
+	if config.EXPORT_QUESTIONS:
+		if config.EXPORT_FORMAT == "parquet":
+			# Write the new and updated questions to `data/questions.parquet`
+			parquet_store.export_questions()
+		else:
+			# Write all questions to `data/questions.json` and `data/questions.csv`
+			stores.export_questions()
 
 	print("Done (for now)")
@@ -0,0 +1,755 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent, indexed storage for the pipeline, backed by a single SQLite database.
+
+Contains:
+- Which OPs have already been processed, keyed by (board, thread id).
+- The merged questions, keyed by the hash of the simplified question.
+  Records are stored as JSON and only hold aggregates (counts, the main subject, first and last sighting).
+- The occurrences of every merged question (OP ID, timestamp, board, original question, subject and
+  'explicit' label), one row each, with the question and subject texts interned in a string table.
+- An index of the merged questions on their count, toxicity, explicitness, boards and last sighting,
+  so screenshots can be selected without loading every record.
+- The LLM and toxicity results per original question, keyed by the normalised hash of the question
+  and its OP text, so we can reuse them.
+- Toxicity scores per provider, keyed by the normalised hash of the scored text.
+- A manifest of catalog snapshots, with their processing status, content hash, and output files.
+- Checkpoints of catalogs that are being processed: their extracted questions, and the results of
+  each stage per original question, so an interrupted run can resume without paying for the same LLM calls.
+- The OpenAI batches that were submitted but whose results weren't retrieved yet, with the custom IDs of their requests.
+"""
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import pandas as pd
+
+import config
+import catalog_store
+
+_connection = None
+
+
+def get_db() -> sqlite3.Connection:
+	"""
+	Get the (lazily created) connection to the pipeline database.
+	"""
+	global _connection
+
+	if _connection is None:
+		_connection = sqlite3.connect(config.DATABASE_FILE)
+		_connection.execute("PRAGMA journal_mode=WAL")
+		_connection.execute("PRAGMA synchronous=NORMAL")
+		has_manifest = _connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catalogs'").fetchone()
+		create_tables(_connection)
+		migrate_processed_ids_json(_connection)
+		migrate_questions_json(_connection)
+		migrate_question_index(_connection)
+		migrate_question_history(_connection)
+		if not has_manifest:
+			migrate_catalog_manifest()
+
+	return _connection
+
+
+def create_tables(db: sqlite3.Connection):
+	with db:
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS processed_ops (
+				board TEXT NOT NULL,
+				thread_id INTEGER NOT NULL,
+				PRIMARY KEY (board, thread_id)
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS questions (
+				hash TEXT PRIMARY KEY,
+				data TEXT NOT NULL
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS question_index (
+				hash TEXT PRIMARY KEY,
+				count INTEGER NOT NULL,
+				toxicity REAL,
+				explicit INTEGER NOT NULL,
+				last_seen INTEGER,
+				captured_count INTEGER NOT NULL DEFAULT 0
+			) WITHOUT ROWID
+		""")
+		# Threshold queries are answered from these indexes alone, without reading the rows
+		db.execute("CREATE INDEX IF NOT EXISTS question_index_count ON question_index (count, toxicity)")
+		db.execute("CREATE INDEX IF NOT EXISTS question_index_toxicity ON question_index (toxicity)")
+		db.execute("CREATE INDEX IF NOT EXISTS question_index_explicit ON question_index (explicit, count, toxicity)")
+		db.execute("CREATE INDEX IF NOT EXISTS question_index_last_seen ON question_index (last_seen)")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS question_boards (
+				board TEXT NOT NULL,
+				hash TEXT NOT NULL,
+				count INTEGER NOT NULL,
+				PRIMARY KEY (board, hash)
+			) WITHOUT ROWID
+		""")
+		db.execute("CREATE INDEX IF NOT EXISTS question_boards_count ON question_boards (board, count)")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS question_occurrences (
+				hash TEXT NOT NULL,
+				board TEXT NOT NULL,
+				op_id INTEGER NOT NULL,
+				timestamp INTEGER NOT NULL,
+				question INTEGER NOT NULL,
+				subject INTEGER NOT NULL,
+				explicit INTEGER NOT NULL,
+				PRIMARY KEY (hash, board, op_id)
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS occurrence_strings (
+				id INTEGER PRIMARY KEY,
+				text TEXT NOT NULL UNIQUE
+			)
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS question_results (
+				hash TEXT PRIMARY KEY,
+				data TEXT NOT NULL
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS toxicity_scores (
+				provider TEXT NOT NULL,
+				cache_key TEXT NOT NULL,
+				hash TEXT NOT NULL,
+				data TEXT NOT NULL,
+				PRIMARY KEY (provider, cache_key, hash)
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS catalogs (
+				path TEXT PRIMARY KEY,
+				board TEXT NOT NULL,
+				timestamp INTEGER NOT NULL,
+				status TEXT NOT NULL DEFAULT 'collected',
+				content_hash TEXT NOT NULL DEFAULT '',
+				outputs TEXT NOT NULL DEFAULT '[]',
+				processed_at INTEGER
+			)
+		""")
+		db.execute("CREATE INDEX IF NOT EXISTS catalogs_status ON catalogs (status, board, timestamp)")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS extracted_catalogs (
+				path TEXT PRIMARY KEY,
+				data TEXT NOT NULL
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS stage_results (
+				stage TEXT NOT NULL,
+				hash TEXT NOT NULL,
+				data TEXT NOT NULL,
+				PRIMARY KEY (hash, stage)
+			) WITHOUT ROWID
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS batches (
+				batch_id TEXT PRIMARY KEY,
+				name TEXT NOT NULL,
+				custom_ids TEXT NOT NULL,
+				submitted_at INTEGER NOT NULL
+			) WITHOUT ROWID
+		""")
+
+
+def migrate_processed_ids_json(db: sqlite3.Connection, processed_ops_json="data/processed_ids.json"):
+	"""
+	Import the flat list of processed IDs we used before.
+	These were stored without a board, so they are added with an empty board name
+	and count as processed for every board.
+	"""
+	if not os.path.isfile(processed_ops_json):
+		return
+
+	with open(processed_ops_json, "r") as in_json:
+		processed_ids = json.load(in_json)
+
+	with db:
+		db.executemany(
+			"INSERT OR IGNORE INTO processed_ops (board, thread_id) VALUES ('', ?)",
+			((op_id,) for op_id in processed_ids)
+		)
+
+	os.replace(processed_ops_json, processed_ops_json + ".migrated")
+	print(f"Migrated {len(processed_ids)} processed IDs from {processed_ops_json} to {config.DATABASE_FILE}")
+
+
+def get_processed_op_ids(board: str, op_ids: list) -> set:
+	"""
+	Returns which of the given OP IDs have already been processed for this board.
+	"""
+	db = get_db()
+	op_ids = list(op_ids)
+	processed = set()
+
+	# Stay below SQLite's maximum number of variables per query
+	for pos in range(0, len(op_ids), 500):
+		op_ids_chunk = op_ids[pos:pos + 500]
+		placeholders = ",".join("?" * len(op_ids_chunk))
+		rows = db.execute(
+			f"SELECT thread_id FROM processed_ops WHERE board IN (?, '') AND thread_id IN ({placeholders})",
+			(board, *op_ids_chunk)
+		)
+		processed.update(row[0] for row in rows)
+
+	return processed
+
+
+def add_processed_op_ids(board: str, op_ids: list, commit=True):
+	"""
+	Mark OP IDs as processed for this board.
+	"""
+	db = get_db()
+	db.executemany(
+		"INSERT OR IGNORE INTO processed_ops (board, thread_id) VALUES (?, ?)",
+		((board, op_id) for op_id in op_ids)
+	)
+	if commit:
+		db.commit()
+
+
+def migrate_questions_json(db: sqlite3.Connection, questions_json_file="data/questions.json"):
+	"""
+	Import the questions from the JSON file we used before.
+	Only done when the database has no questions yet, since `export_questions()` writes to the same file.
+	"""
+	if not os.path.isfile(questions_json_file):
+		return
+
+	if db.execute("SELECT 1 FROM questions LIMIT 1").fetchone():
+		return
+
+	with open(questions_json_file, "r") as in_json:
+		questions = json.load(in_json)
+
+	with db:
+		db.executemany(
+			"INSERT OR IGNORE INTO questions (hash, data) VALUES (?, ?)",
+			((question_hash, json.dumps(question)) for question_hash, question in questions.items())
+		)
+
+	print(f"Migrated {len(questions)} questions from {questions_json_file} to {config.DATABASE_FILE}")
+
+
+def get_questions(question_hashes: list) -> dict:
+	"""
+	Get stored questions by their hash. Unknown hashes are left out.
+	"""
+	db = get_db()
+	question_hashes = list(question_hashes)
+	questions = {}
+
+	for pos in range(0, len(question_hashes), 500):
+		hashes_chunk = question_hashes[pos:pos + 500]
+		placeholders = ",".join("?" * len(hashes_chunk))
+		rows = db.execute(f"SELECT hash, data FROM questions WHERE hash IN ({placeholders})", hashes_chunk)
+		questions.update({row[0]: json.loads(row[1]) for row in rows})
+
+	return questions
+
+
+def get_all_questions() -> dict:
+	"""
+	Get all stored questions, keyed by their hash.
+	"""
+	return {row[0]: json.loads(row[1]) for row in get_db().execute("SELECT hash, data FROM questions")}
+
+
+def upsert_questions(questions: dict, commit=True, db: sqlite3.Connection = None):
+	"""
+	Insert or replace question records, keyed by their hash, and update their index.
+	"""
+	db = db or get_db()
+	db.executemany(
+		"INSERT INTO questions (hash, data) VALUES (?, ?) ON CONFLICT(hash) DO UPDATE SET data = excluded.data",
+		((question_hash, json.dumps(question)) for question_hash, question in questions.items())
+	)
+	index_questions(questions, db)
+	if commit:
+		db.commit()
+
+
+def get_toxicity(question: dict):
+	"""
+	The Perspective toxicity score of a question record, or None if it wasn't scored
+	(e.g. when the Perspective call failed).
+	"""
+	toxicity = question.get("TOXICITY")
+	if isinstance(toxicity, (int, float)) and not isinstance(toxicity, bool):
+		return float(toxicity)
+	return None
+
+
+def index_questions(questions: dict, db: sqlite3.Connection):
+	"""
+	Add question records to the index used by `get_questions_above_thresholds()`.
+	"""
+	db.executemany(
+		"""
+		INSERT INTO question_index (hash, count, toxicity, explicit, last_seen) VALUES (?, ?, ?, ?, ?)
+		ON CONFLICT(hash) DO UPDATE SET count = excluded.count, toxicity = excluded.toxicity,
+			explicit = excluded.explicit, last_seen = excluded.last_seen
+		""",
+		(
+			(question_hash, question["count"], get_toxicity(question), int(bool(question.get("explicit"))), question.get("last_seen"))
+			for question_hash, question in questions.items()
+		)
+	)
+	db.executemany(
+		"INSERT INTO question_boards (board, hash, count) VALUES (?, ?, ?) ON CONFLICT(board, hash) DO UPDATE SET count = excluded.count",
+		(
+			(key[:-len("_count")], question_hash, value)
+			for question_hash, question in questions.items()
+			for key, value in question.items() if key.endswith("_count") and value
+		)
+	)
+
+
+def migrate_question_index(db: sqlite3.Connection):
+	"""
+	Index the questions we stored before there was an index.
+	Only done when the index is empty, so we don't go over all records on every run.
+	"""
+	if db.execute("SELECT 1 FROM question_index LIMIT 1").fetchone():
+		return
+
+	questions = {row[0]: json.loads(row[1]) for row in db.execute("SELECT hash, data FROM questions")}
+	if not questions:
+		return
+
+	with db:
+		index_questions(questions, db)
+
+	print(f"Indexed {len(questions)} questions")
+
+
+def get_questions_above_thresholds(min_count: int, min_toxicity: float, must_be_explicit: bool,
+								   boards: list = None, seen_since: int = None, new_since_capture=False) -> dict:
+	"""
+	Get the questions that were seen at least `min_count` times and have a toxicity score of at least
+	`min_toxicity`, with an index lookup. Questions without a toxicity score are left out.
+
+	Optionally only returns questions that are explicit, that were seen at least `min_count` times on
+	one of `boards`, that were last seen at or after the `seen_since` timestamp, or that were seen
+	again since `set_questions_captured()`.
+	"""
+	db = get_db()
+	conditions = ["question_index.count >= ?", "toxicity >= ?"]
+	values = [min_count, min_toxicity]
+
+	if must_be_explicit:
+		conditions.append("explicit = 1")
+	if seen_since is not None:
+		conditions.append("last_seen >= ?")
+		values.append(seen_since)
+	if new_since_capture:
+		conditions.append("question_index.count > captured_count")
+	if boards:
+		placeholders = ",".join("?" * len(boards))
+		conditions.append(f"hash IN (SELECT hash FROM question_boards WHERE board IN ({placeholders}) AND count >= ?)")
+		values += [*boards, min_count]
+
+	rows = db.execute(f"SELECT hash FROM question_index WHERE {' AND '.join(conditions)}", values)
+	return get_questions([row[0] for row in rows])
+
+
+def count_questions() -> int:
+	return get_db().execute("SELECT COUNT(*) FROM question_index").fetchone()[0]
+
+
+def set_questions_captured(questions: dict, commit=True):
+	"""
+	Remember the count of questions we took screenshots of, for `new_since_capture`.
+	"""
+	db = get_db()
+	db.executemany(
+		"UPDATE question_index SET captured_count = ? WHERE hash = ?",
+		((question["count"], question_hash) for question_hash, question in questions.items())
+	)
+	if commit:
+		db.commit()
+
+
+def migrate_question_history(db: sqlite3.Connection):
+	"""
+	Move the occurrence lists (`ids`, `timestamps`, `questions_original`, `subjects_all` and
+	`explicit_all`) out of question records we stored before, into the occurrence table.
+	Their board wasn't kept, so they're added with an empty board name.
+
+	Only done when there are no occurrences yet, so we don't go over all records on every run.
+	"""
+	if db.execute("SELECT 1 FROM question_occurrences LIMIT 1").fetchone():
+		return
+
+	migrated = {}
+	occurrences = []
+	for question_hash, data in db.execute("SELECT hash, data FROM questions"):
+		question = json.loads(data)
+		if "ids" not in question:
+			continue
+
+		occurrences += [
+			(question_hash, "", op_id, timestamp, question_original, subject, explicit)
+			for op_id, timestamp, question_original, subject, explicit in zip(
+				question.pop("ids"), question.pop("timestamps"), question.pop("questions_original"),
+				question.pop("subjects_all"), question.pop("explicit_all"))
+		]
+		migrated[question_hash] = question
+
+	if not migrated:
+		return
+
+	# Aggregates of the history that records now keep instead
+	for question in migrated.values():
+		question["subject_counts"] = {}
+		question["explicit_counts"] = {}
+		question["first_seen"] = None
+		question["last_seen"] = None
+	for question_hash, board, op_id, timestamp, question_original, subject, explicit in occurrences:
+		question = migrated[question_hash]
+		question["subject_counts"][subject] = question["subject_counts"].get(subject, 0) + 1
+		explicit_key = json.dumps(explicit)
+		question["explicit_counts"][explicit_key] = question["explicit_counts"].get(explicit_key, 0) + 1
+		question["first_seen"] = min(timestamp, question["first_seen"] or timestamp)
+		question["last_seen"] = max(timestamp, question["last_seen"] or timestamp)
+
+	with db:
+		upsert_questions(migrated, commit=False, db=db)
+		add_question_occurrences(occurrences, commit=False, db=db)
+
+	print(f"Moved {len(occurrences)} occurrences of {len(migrated)} questions to the occurrence table")
+
+
+def get_string_ids(texts, db: sqlite3.Connection = None) -> dict:
+	"""
+	Get the IDs of interned strings, adding the ones we haven't seen before.
+	"""
+	db = db or get_db()
+	texts = list(set(texts))
+	db.executemany("INSERT OR IGNORE INTO occurrence_strings (text) VALUES (?)", ((text,) for text in texts))
+
+	string_ids = {}
+	for pos in range(0, len(texts), 500):
+		texts_chunk = texts[pos:pos + 500]
+		placeholders = ",".join("?" * len(texts_chunk))
+		rows = db.execute(f"SELECT text, id FROM occurrence_strings WHERE text IN ({placeholders})", texts_chunk)
+		string_ids.update(rows)
+
+	return string_ids
+
+
+def get_known_occurrences(occurrence_keys: list) -> set:
+	"""
+	Returns which of the given (question hash, board, OP ID) occurrences are already stored.
+	Every key is looked up on the primary key, so this doesn't slow down as the number of occurrences grows.
+	"""
+	db = get_db()
+	known = set()
+
+	for occurrence_key in set(occurrence_keys):
+		if db.execute("SELECT 1 FROM question_occurrences WHERE hash = ? AND board = ? AND op_id = ?", occurrence_key).fetchone():
+			known.add(occurrence_key)
+
+	return known
+
+
+def add_question_occurrences(occurrences: list, commit=True, db: sqlite3.Connection = None):
+	"""
+	Store occurrences of merged questions, as
+	(question hash, board, OP ID, timestamp, original question, subject, explicit) tuples.
+	"""
+	db = db or get_db()
+	string_ids = get_string_ids([text for occurrence in occurrences for text in occurrence[4:6]], db)
+	db.executemany(
+		"INSERT OR IGNORE INTO question_occurrences (hash, board, op_id, timestamp, question, subject, explicit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+		(
+			(question_hash, board, op_id, timestamp, string_ids[question_original], string_ids[subject], int(explicit))
+			for question_hash, board, op_id, timestamp, question_original, subject, explicit in occurrences
+		)
+	)
+	if commit:
+		db.commit()
+
+
+def get_question_histories(question_hashes: list) -> dict:
+	"""
+	Get the occurrences of merged questions as lists, in the order they were seen
+	(the way question records used to keep them), keyed by the question hash.
+	"""
+	db = get_db()
+	question_hashes = list(question_hashes)
+	histories = {
+		question_hash: {"boards": [], "ids": [], "timestamps": [], "questions_original": [], "subjects_all": [], "explicit_all": []}
+		for question_hash in question_hashes
+	}
+
+	for pos in range(0, len(question_hashes), 500):
+		hashes_chunk = question_hashes[pos:pos + 500]
+		placeholders = ",".join("?" * len(hashes_chunk))
+		rows = db.execute(f"""
+			SELECT hash, board, op_id, timestamp, question_strings.text, subject_strings.text, explicit FROM question_occurrences
+			JOIN occurrence_strings AS question_strings ON question_strings.id = question_occurrences.question
+			JOIN occurrence_strings AS subject_strings ON subject_strings.id = question_occurrences.subject
+			WHERE hash IN ({placeholders})
+			ORDER BY hash, timestamp, op_id
+		""", hashes_chunk)
+
+		for question_hash, board, op_id, timestamp, question_original, subject, explicit in rows:
+			history = histories[question_hash]
+			history["boards"].append(board)
+			history["ids"].append(op_id)
+			history["timestamps"].append(timestamp)
+			history["questions_original"].append(question_original)
+			history["subjects_all"].append(subject)
+			history["explicit_all"].append(bool(explicit))
+
+	return histories
+
+
+def get_question_history(question_hash: str) -> dict:
+	"""
+	Get the occurrences of a merged question as lists, in the order they were seen.
+	"""
+	return get_question_histories([question_hash])[question_hash]
+
+
+def get_question_results(question_hashes: list) -> dict:
+	"""
+	Get the stored LLM and toxicity results for original questions, keyed by their normalised hash.
+	"""
+	db = get_db()
+	question_hashes = list(question_hashes)
+	results = {}
+
+	for pos in range(0, len(question_hashes), 500):
+		hashes_chunk = question_hashes[pos:pos + 500]
+		placeholders = ",".join("?" * len(hashes_chunk))
+		rows = db.execute(f"SELECT hash, data FROM question_results WHERE hash IN ({placeholders})", hashes_chunk)
+		results.update({row[0]: json.loads(row[1]) for row in rows})
+
+	return results
+
+
+def add_question_results(results: dict, commit=True):
+	"""
+	Store the LLM and toxicity results of original questions, keyed by their normalised hash.
+	"""
+	db = get_db()
+	db.executemany(
+		"INSERT OR REPLACE INTO question_results (hash, data) VALUES (?, ?)",
+		((question_hash, json.dumps(result)) for question_hash, result in results.items())
+	)
+	if commit:
+		db.commit()
+
+
+def get_toxicity_scores(provider: str, cache_key: str, text_hashes: list) -> dict:
+	"""
+	Get cached toxicity scores of a provider, keyed by the normalised hash of the text.
+	Only returns scores that were stored with the same `cache_key` (models, attributes and version).
+	"""
+	db = get_db()
+	text_hashes = list(set(text_hashes))
+	scores = {}
+
+	for pos in range(0, len(text_hashes), 500):
+		hashes_chunk = text_hashes[pos:pos + 500]
+		placeholders = ",".join("?" * len(hashes_chunk))
+		rows = db.execute(
+			f"SELECT hash, data FROM toxicity_scores WHERE provider = ? AND cache_key = ? AND hash IN ({placeholders})",
+			(provider, cache_key, *hashes_chunk)
+		)
+		scores.update({row[0]: json.loads(row[1]) for row in rows})
+
+	return scores
+
+
+def add_toxicity_scores(provider: str, cache_key: str, scores: dict, commit=True):
+	"""
+	Cache toxicity scores of a provider, keyed by the normalised hash of the text.
+	"""
+	db = get_db()
+	db.executemany(
+		"INSERT OR REPLACE INTO toxicity_scores (provider, cache_key, hash, data) VALUES (?, ?, ?, ?)",
+		((provider, cache_key, text_hash, json.dumps(score)) for text_hash, score in scores.items())
+	)
+	if commit:
+		db.commit()
+
+
+def export_questions(questions_json_file="data/questions.json", questions_csv_file="data/questions.csv"):
+	"""
+	Export all questions as a JSON and CSV file.
+	"""
+	questions = get_all_questions()
+
+	with open(questions_json_file, "w", encoding="utf-8") as out_json:
+		json.dump(questions, out_json)
+
+	df = pd.DataFrame(questions.values())
+	df.to_csv(questions_csv_file, index=False)
+
+	print(f"Exported {len(questions)} questions to {questions_json_file} and {questions_csv_file}")
+
+
+def register_catalog(path: str, board: str, timestamp: int, content_hash: str):
+	"""
+	Add a collected catalog snapshot to the manifest, to be processed later.
+	"""
+	db = get_db()
+	with db:
+		db.execute(
+			"INSERT OR IGNORE INTO catalogs (path, board, timestamp, content_hash) VALUES (?, ?, ?, ?)",
+			(path, board, timestamp, content_hash)
+		)
+
+
+def register_untracked_catalogs(paths: list):
+	"""
+	Add catalog snapshots that are on disk but not in the manifest,
+	e.g. those collected before the manifest existed.
+	"""
+	db = get_db()
+	tracked = set(row[0] for row in db.execute("SELECT path FROM catalogs"))
+	untracked = [path for path in paths if path not in tracked]
+
+	for path in untracked:
+		with open(path, "rb") as in_file:
+			content_hash = hashlib.sha256(in_file.read()).hexdigest()
+		board = os.path.basename(path).split("_")[0]
+		timestamp = int(os.path.basename(catalog_store.snapshot_name(path)).split("_")[-1])
+		register_catalog(path, board, timestamp, content_hash)
+
+	if untracked:
+		print(f"Added {len(untracked)} untracked catalog files to the manifest")
+
+
+def migrate_catalog_manifest():
+	"""
+	Add the catalog snapshots that were collected before there was a manifest.
+	Only done when the manifest is created, so we don't go over every snapshot on disk on every run.
+	New snapshots are added as they're collected (see `chan_catalogs.collect()`).
+	"""
+	register_untracked_catalogs(catalog_store.list_snapshots())
+
+
+def get_unprocessed_catalogs() -> list:
+	"""
+	Get the paths of catalog snapshots that haven't been processed yet, oldest first per board.
+	Only reads the index entries of those snapshots, not the whole manifest.
+	"""
+	rows = get_db().execute("SELECT path FROM catalogs WHERE status = 'collected' ORDER BY board, timestamp")
+	return [row[0] for row in rows]
+
+
+def set_catalog_processed(path: str, outputs: list):
+	"""
+	Mark a catalog snapshot as processed and store what output files it produced.
+	"""
+	db = get_db()
+	with db:
+		db.execute(
+			"UPDATE catalogs SET status = 'processed', outputs = ?, processed_at = ? WHERE path = ?",
+			(json.dumps(outputs), int(time.time()), path)
+		)
+
+
+def get_extracted_catalog(path: str):
+	"""
+	Get the saved extraction of a catalog snapshot that is being processed, or None.
+	"""
+	row = get_db().execute("SELECT data FROM extracted_catalogs WHERE path = ?", (path,)).fetchone()
+	return json.loads(row[0]) if row else None
+
+
+def save_extracted_catalogs(extracted_catalogs: list, commit=True):
+	"""
+	Save the extracted questions of catalog snapshots (see `chan_questions.extract_catalog()`),
+	so they don't have to be extracted again if processing is interrupted.
+	"""
+	db = get_db()
+	db.executemany(
+		"INSERT OR REPLACE INTO extracted_catalogs (path, data) VALUES (?, ?)",
+		((extracted["catalog_file"], json.dumps(extracted)) for extracted in extracted_catalogs)
+	)
+	if commit:
+		db.commit()
+
+
+def get_stage_results(stage: str, question_hashes: list) -> dict:
+	"""
+	Get the saved results of a processing stage for original questions, keyed by their normalised hash.
+	"""
+	db = get_db()
+	question_hashes = list(question_hashes)
+	results = {}
+
+	for pos in range(0, len(question_hashes), 500):
+		hashes_chunk = question_hashes[pos:pos + 500]
+		placeholders = ",".join("?" * len(hashes_chunk))
+		rows = db.execute(f"SELECT hash, data FROM stage_results WHERE stage = ? AND hash IN ({placeholders})", [stage] + hashes_chunk)
+		results.update({row[0]: json.loads(row[1]) for row in rows})
+
+	return results
+
+
+def add_stage_results(stage: str, results: dict, commit=True):
+	"""
+	Save the results of a processing stage for original questions, keyed by their normalised hash.
+	"""
+	db = get_db()
+	db.executemany(
+		"INSERT OR REPLACE INTO stage_results (stage, hash, data) VALUES (?, ?, ?)",
+		((stage, question_hash, json.dumps(result)) for question_hash, result in results.items())
+	)
+	if commit:
+		db.commit()
+
+
+def delete_checkpoints(path: str, question_hashes: list, commit=True):
+	"""
+	Remove the checkpoints of a catalog snapshot and its questions once it's merged.
+	"""
+	db = get_db()
+	db.execute("DELETE FROM extracted_catalogs WHERE path = ?", (path,))
+	db.executemany("DELETE FROM stage_results WHERE hash = ?", ((question_hash,) for question_hash in set(question_hashes)))
+	if commit:
+		db.commit()
+
+
+def get_batches(name: str) -> dict:
+	"""
+	Get the submitted batches of a kind of request (e.g. "simplify"), as a dict of batch IDs and their custom IDs.
+	"""
+	rows = get_db().execute("SELECT batch_id, custom_ids FROM batches WHERE name = ? ORDER BY submitted_at", (name,))
+	return {row[0]: json.loads(row[1]) for row in rows}
+
+
+def add_batch(batch_id: str, name: str, custom_ids: list):
+	"""
+	Save a submitted batch, so a re-run waits for it instead of submitting the same requests again.
+	"""
+	db = get_db()
+	with db:
+		db.execute(
+			"INSERT OR REPLACE INTO batches (batch_id, name, custom_ids, submitted_at) VALUES (?, ?, ?, ?)",
+			(batch_id, name, json.dumps(custom_ids), int(time.time()))
+		)
+
+
+def delete_batch(batch_id: str):
+	"""
+	Forget a batch once its results are retrieved, or when they're not needed anymore.
+	"""
+	db = get_db()
+	with db:
+		db.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
@@ -0,0 +1,181 @@
+"""
+Tests for `openai_batch.run_batch()` and merging batch results into the questions,
+with a fake batch backend instead of OpenAI.
+
+Run them from the repository root:
+
+`python -m unittest discover tests`
+"""
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py isn't part of the repository; the example has every setting
+if importlib.util.find_spec("config") is None:
+	spec = importlib.util.spec_from_file_location("config", os.path.join(ROOT, "config-example.py"))
+	sys.modules["config"] = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(sys.modules["config"])
+
+import config
+import stores
+import openai_batch
+import chan_questions
+
+from openai.types.moderation import CategoryScores
+
+
+class FakeBatchBackend(openai_batch.BatchBackend):
+	"""
+	Runs batches locally. A batch is done after it's polled once, and responses
+	are returned in reverse order, so results have to be matched by custom ID.
+	"""
+
+	def __init__(self, answer, failing_custom_ids=()):
+		self.answer = answer
+		self.failing_custom_ids = set(failing_custom_ids)
+		self.batches = {}
+		self.polls = {}
+
+	def submit(self, batch_file: str, endpoint: str) -> str:
+		batch_id = f"batch_{len(self.batches)}"
+		with open(batch_file, encoding="utf-8") as in_jsonl:
+			self.batches[batch_id] = [json.loads(line) for line in in_jsonl]
+		self.polls[batch_id] = 0
+		return batch_id
+
+	def poll(self, batch_id: str) -> str:
+		self.polls[batch_id] += 1
+		return "completed" if self.polls[batch_id] > 1 else "in_progress"
+
+	def get_results(self, batch_id: str) -> list:
+		return [{
+			"custom_id": request["custom_id"],
+			"response": {
+				"status_code": 500 if request["custom_id"] in self.failing_custom_ids else 200,
+				"body": self.answer(request["body"])
+			}
+		} for request in reversed(self.batches[batch_id])]
+
+
+class InterruptedBatchBackend(FakeBatchBackend):
+	"""
+	A backend whose first poll fails, like a run that's stopped while waiting for its batches.
+	"""
+
+	def poll(self, batch_id: str) -> str:
+		if not any(self.polls.values()):
+			self.polls[batch_id] += 1
+			raise KeyboardInterrupt
+		return super().poll(batch_id)
+
+
+def echo(body: dict) -> dict:
+	return {"echo": body["input"]}
+
+
+def simplify(body: dict) -> dict:
+	"""
+	Answer a simplification prompt by upper-casing the questions.
+	"""
+	questions = json.loads(body["messages"][0]["content"].split("Input: ", 1)[1])
+	results = [{"id": q["id"], "question_simplified_contextualized": q["question"].upper(), "subject": "test"} for q in questions]
+	return {"choices": [{"message": {"content": json.dumps({"results": results})}}]}
+
+
+class TestRunBatch(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.settings = {name: getattr(config, name) for name in ("DATABASE_FILE", "BATCH_DIR", "BATCH_POLL_INTERVAL", "BATCH_MAX_REQUESTS", "BATCH_MAX_BYTES", "LLM_CACHE", "CHUNKS")}
+		config.DATABASE_FILE = os.path.join(self.temp_dir.name, "test.db")
+		config.BATCH_DIR = os.path.join(self.temp_dir.name, "batches")
+		config.BATCH_POLL_INTERVAL = 0
+		config.BATCH_MAX_REQUESTS = 2
+		config.BATCH_MAX_BYTES = 1024 * 1024
+		config.LLM_CACHE = False
+		config.CHUNKS = 2
+		stores._connection = None
+
+	def tearDown(self):
+		stores.get_db().close()
+		stores._connection = None
+		openai_batch.set_backend(None)
+		for name, value in self.settings.items():
+			setattr(config, name, value)
+		self.temp_dir.cleanup()
+
+	def test_responses_by_custom_id(self):
+		backend = FakeBatchBackend(echo, failing_custom_ids=["test-3"])
+		openai_batch.set_backend(backend)
+		requests = {f"test-{i}": {"input": f"text {i}"} for i in range(5)}
+
+		responses = asyncio.run(openai_batch.run_batch(requests, "/v1/moderations", "test"))
+
+		self.assertEqual(len(backend.batches), 3)
+		self.assertEqual(responses, {f"test-{i}": {"echo": f"text {i}"} for i in (0, 1, 2, 4)})
+		self.assertEqual(stores.get_batches("test"), {})
+
+	def test_split_batch_files_by_size(self):
+		backend = FakeBatchBackend(echo)
+		openai_batch.set_backend(backend)
+		config.BATCH_MAX_REQUESTS = 100
+		config.BATCH_MAX_BYTES = 5000
+		requests = {f"test-{i}": {"input": f"{i} " * 500} for i in range(10)}
+
+		responses = asyncio.run(openai_batch.run_batch(requests, "/v1/moderations", "test"))
+
+		self.assertGreater(len(backend.batches), 1)
+		for batch_file in os.listdir(config.BATCH_DIR):
+			self.assertLessEqual(os.path.getsize(os.path.join(config.BATCH_DIR, batch_file)), config.BATCH_MAX_BYTES)
+		self.assertEqual(responses.keys(), requests.keys())
+
+	def test_resume_submitted_batches(self):
+		backend = InterruptedBatchBackend(echo)
+		openai_batch.set_backend(backend)
+		requests = {f"test-{i}": {"input": f"text {i}"} for i in range(3)}
+
+		with self.assertRaises(KeyboardInterrupt):
+			asyncio.run(openai_batch.run_batch(requests, "/v1/moderations", "test"))
+		self.assertEqual(len(stores.get_batches("test")), 2)
+
+		# The next run has one more request: only that one is submitted
+		requests["test-3"] = {"input": "text 3"}
+		responses = asyncio.run(openai_batch.run_batch(requests, "/v1/moderations", "test"))
+
+		self.assertEqual(len(backend.batches), 3)
+		self.assertEqual(backend.batches["batch_2"][0]["custom_id"], "test-3")
+		self.assertEqual(responses, {f"test-{i}": {"echo": f"text {i}"} for i in range(4)})
+		self.assertEqual(stores.get_batches("test"), {})
+
+	def test_merge_llm_results_into_questions(self):
+		openai_batch.set_backend(FakeBatchBackend(simplify))
+		questions = [{"question": f"Is this question {i}?", "title": "", "body": f"OP {i}"} for i in range(5)]
+
+		results = asyncio.run(chan_questions.run_llm_stage_as_batch(
+			questions, None, "Input: [input]", chan_questions.get_simplify_input, chan_questions.validate_simplified,
+			chan_questions.simplify_chunk, chan_questions.get_simplify_tokens, "Simplified", "simplify"))
+
+		self.assertEqual([result["question_simplified_contextualized"] for result in results], [f"IS THIS QUESTION {i}?" for i in range(5)])
+
+	def test_moderation_columns_match_interactive_scores(self):
+		categories = ("harassment", "harassment/threatening", "hate", "hate/threatening", "illicit", "illicit/violent", "self-harm",
+			"self-harm/instructions", "self-harm/intent", "sexual", "sexual/minors", "violence", "violence/graphic")
+		category_scores = {category: i / 100 for i, category in enumerate(categories)}
+		openai_batch.set_backend(FakeBatchBackend(lambda body: {"results": [{"category_scores": category_scores} for text in body["input"]]}))
+
+		batch_results = asyncio.run(chan_questions.get_toxicity_scores_openai_as_batch(["text 0", "text 1"], [[0, 1]]))
+		interactive_scores = chan_questions.parse_moderation_scores(CategoryScores.model_validate(category_scores))
+
+		self.assertEqual(batch_results, [[interactive_scores, interactive_scores]])
+		self.assertIn("SELF_HARM_INTENT", interactive_scores)
+
+
+if __name__ == "__main__":
+	unittest.main()